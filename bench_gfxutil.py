@@ -0,0 +1,315 @@
+#!/usr/bin/python
+
+"""Microbenchmarks for the gfxutil geometry functions, at the point counts
+   and mesh steps the eye clients use (32 points and 4 steps for the iris,
+   33 points and 5 steps for the eyelids) and at 4x and 16x that. Results
+   can be saved as a JSON baseline, and later runs compared against it to
+   flag anything that has got slower. The batched SVG sampler and the
+   NumPy point and mesh functions are also checked against reference
+   versions (svg.path's own sampling, and the original pure Python loops
+   kept here, since the list functions in gfxutil now wrap the NumPy
+   ones).
+   pi3d is replaced by a stub if it can't be imported, so this runs
+   headless on any machine with numpy and svg.path:
+
+      python3 bench_gfxutil.py [--save FILE] [--compare FILE]
+                               [--tolerance 0.25] [--filter TEXT]
+
+   e.g. --save bench_gfxutil.json before a change, then --compare
+   bench_gfxutil.json after it. Baselines are machine specific, so
+   aren't kept in the repository. Exits with status 1 if a check fails
+   or anything has regressed."""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+import types
+import numpy as np
+from svg.path import parse_path
+
+try:
+    import pi3d
+    PI3D_STUB = False
+except Exception: # Not installed, or no display libraries to load
+    PI3D_STUB = True
+
+if PI3D_STUB:
+    class _Shape(object):
+        def __init__(self, *args):
+            pass
+
+    class _Buffer(object):
+        """pi3d's interleaved vertex array (position, normal, texture
+           coordinates), without the GL upload."""
+
+        def __init__(self, shape, pts, texcoords, faces, normals=None,
+                     smooth=True):
+            self.array_buffer = np.zeros((len(pts), 8), dtype=np.float32)
+            self.array_buffer[:, 0:3] = pts
+            self.array_buffer[:, 3:6] = normals
+            self.array_buffer[:, 6:8] = texcoords
+            self.element_array_buffer = np.array(faces, dtype=np.uint16)
+
+        def re_init(self, pts=None, texcoords=None, normals=None, offset=0):
+            if pts is not None:
+                self.array_buffer[offset:offset + len(pts), 0:3] = pts
+
+    pi3d = types.ModuleType("pi3d")
+    pi3d.Shape = _Shape
+    pi3d.Buffer = _Buffer
+    sys.modules["pi3d"] = pi3d
+
+from gfxutil import (index_svg, mesh_init, path_to_points,
+                     path_to_points_array, points_bounds,
+                     points_bounds_array, points_interp, points_interp_array,
+                     points_mesh, points_mesh_array, scale_points,
+                     scale_points_array)
+
+SVG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "graphics", "eye.svg")
+
+# (name, SVG paths, points, steps, closed) as used by the clients
+SHAPES = (
+    ("iris", ("pupilMin", "iris"), 32, 4, True),
+    ("lid", ("upperLidOpen", "upperLidClosed"), 33, 5, False),
+)
+SCALES = (1, 4, 16)
+
+REPEAT = 7         # Best of this many timing runs
+RUN_SECONDS = 0.05 # Calls per run are chosen to take about this long
+RETRIES = 2        # Times an apparent regression is timed again
+
+
+def _functions(path, pts1, pts2, num_points, steps, closed, view_box):
+    """(function name, call) pairs for one shape at one size. svg.path
+       caches segment lengths in the Path object, so the path samplers
+       are timed on a freshly parsed path, as when loading the SVG."""
+    radius = 300.0
+    d = path.d()
+    arr1 = np.array(pts1, dtype=np.float32)
+    arr2 = np.array(pts2, dtype=np.float32)
+    out = np.empty_like(arr1)
+    edge = None if closed else pts1
+    edge_arr = None if closed else arr1
+    return (
+        ("parse_path", lambda: parse_path(d)),
+        ("path_to_points",
+         lambda: path_to_points(parse_path(d), num_points, closed, True)),
+        ("path_to_points_array",
+         lambda: path_to_points_array(parse_path(d), num_points, closed,
+                                      True)),
+        ("scale_points",
+         lambda: scale_points(list(pts1), view_box, radius)),
+        ("scale_points_array",
+         lambda: scale_points_array(arr1, view_box, radius)),
+        ("points_interp", lambda: points_interp(pts1, pts2, 0.3)),
+        ("points_interp_array",
+         lambda: points_interp_array(arr1, arr2, 0.3, out)),
+        ("points_bounds", lambda: points_bounds(pts1)),
+        ("points_bounds_array", lambda: points_bounds_array(arr1)),
+        ("points_mesh",
+         lambda: points_mesh((edge, pts1, pts2), steps, 0, True)),
+        ("points_mesh_array",
+         lambda: points_mesh_array((edge_arr, arr1, arr2), steps, 0, True)),
+        ("mesh_init",
+         lambda: mesh_init((num_points, steps), (0.5, 0.001), closed,
+                           not closed)),
+    )
+
+
+def cases(paths, view_box):
+    """Yield (benchmark name, call) for every function, shape and size."""
+    for shape, (name1, name2), base_points, base_steps, closed in SHAPES:
+        for scale in SCALES:
+            num_points = base_points * scale
+            steps = base_steps * scale
+            label = "%s x%d (%d points, %d steps)" % (shape, scale,
+                                                      num_points, steps)
+            pts1 = path_to_points(paths[name1], num_points, closed, True)
+            pts2 = path_to_points(paths[name2], num_points, closed, True)
+            for function, call in _functions(paths[name1], pts1, pts2,
+                                             num_points, steps, closed,
+                                             view_box):
+                yield "%s: %s" % (function, label), call
+
+
+def time_call(call):
+    """Best time of REPEAT runs, in microseconds per call."""
+    timer = timeit.Timer(call)
+    once = timer.timeit(1) # Also warms up
+    number = max(int(RUN_SECONDS / max(once, 1e-7)), 1)
+    return min(timer.repeat(REPEAT, number)) / number * 1e6
+
+
+# The original pure Python versions of the point and mesh functions, as
+# references for check()
+
+def _ref_scale_points(points, view_box, radius):
+    for point_num, _ in enumerate(points):
+        points[point_num] = (((points[point_num][0] - view_box[0]) /
+                              view_box[2] - 0.5) * radius *  2.0,
+                             ((points[point_num][1] - view_box[1]) /
+                              view_box[3] - 0.5) * radius * -2.0)
+
+
+def _ref_points_interp(points1, points2, weight2):
+    num_points = min(len(points1), len(points2))
+    if num_points < 1:
+        return None
+    weight2 = min(max(0.0, weight2), 1.0)
+    weight1 = 1.0 - weight2
+    points = []
+    for point_num in range(num_points):
+        points.append(
+            (points1[point_num][0] * weight1 + points2[point_num][0] * weight2,
+             points1[point_num][1] * weight1 + points2[point_num][1] * weight2))
+    return points
+
+
+def _ref_points_bounds(points):
+    min_x, min_y, max_x, max_y = (points[0][0], points[0][1],
+                                  points[0][0], points[0][1])
+    for point in points[1:]:
+        min_x = min(min_x, point[0])
+        min_y = min(min_y, point[1])
+        max_x = max(max_x, point[0])
+        max_y = max(max_y, point[1])
+    return (min_x, min_y, max_x, max_y)
+
+
+def _ref_points_mesh(points, steps, z_coord, flip=False):
+    steps = max(steps, 2)
+    num_points = min(len(points[1]), len(points[2]))
+    if num_points < 1:
+        return None
+    verts = []
+    sign = -1.0 if flip else 1.0
+    order = reversed if flip else list
+    if points[0]:
+        for point in order(points[0]):
+            verts.append((sign * point[0], point[1], z_coord))
+    div = float(steps - 1)
+    for y_index in range(steps):
+        point_list = _ref_points_interp(points[1], points[2], y_index / div)
+        for point in order(point_list):
+            verts.append((sign * point[0], point[1], z_coord))
+    return verts
+
+
+def _compare(failures, description, ref, new, limit=1e-3):
+    ref = np.array(ref, dtype=float)
+    new = np.array(new, dtype=float)
+    if ref.shape != new.shape:
+        failures.append((description + " shape", float("inf"), limit))
+        return
+    diff = float(np.abs(ref - new).max())
+    if diff > limit:
+        failures.append((description, diff, limit))
+
+
+def check(paths, view_box):
+    """Compare the batched versions against the reference ones, returning
+       a list of (description, max difference, limit) failures."""
+    failures = []
+    for shape, names, num_points, steps, closed in SHAPES:
+        for name in names:
+            for scale in SCALES:
+                n = num_points * scale
+                _compare(failures, "path_to_points_array %s %d" % (name, n),
+                         path_to_points(paths[name], n, closed, True),
+                         path_to_points_array(paths[name], n, closed, True))
+        pts1 = path_to_points(paths[names[0]], num_points, closed, True)
+        pts2 = path_to_points(paths[names[1]], num_points, closed, True)
+        arr1 = np.array(pts1, dtype=np.float32)
+        arr2 = np.array(pts2, dtype=np.float32)
+        ref = list(pts1)
+        _ref_scale_points(ref, view_box, 300.0)
+        _compare(failures, "scale_points_array %s" % shape, ref,
+                 scale_points_array(arr1, view_box, 300.0))
+        for weight in (0.0, 0.3, 1.0):
+            _compare(failures, "points_interp_array %s %g" % (shape, weight),
+                     _ref_points_interp(pts1, pts2, weight),
+                     points_interp_array(arr1, arr2, weight))
+        _compare(failures, "points_bounds_array %s" % shape,
+                 _ref_points_bounds(pts1), points_bounds_array(arr1))
+        edge = None if closed else pts1
+        edge_arr = None if closed else arr1
+        for flip in (False, True):
+            _compare(failures, "points_mesh_array %s flip=%s" % (shape, flip),
+                     _ref_points_mesh((edge, pts1, pts2), steps, 0, flip),
+                     points_mesh_array((edge_arr, arr1, arr2), steps, 0,
+                                       flip))
+    return failures
+
+
+def environment():
+    return {"python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "pi3d_stub": PI3D_STUB}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark gfxutil geometry functions")
+    parser.add_argument("--save", metavar="FILE",
+                        help="save results as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare results against a JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="flag results this much slower than the "
+                             "baseline (0.25 = 25%%)")
+    parser.add_argument("--filter", default="",
+                        help="only run benchmarks whose name contains this")
+    args = parser.parse_args()
+
+    view_box, paths = index_svg(SVG_FILE)
+
+    failures = check(paths, view_box)
+    for description, diff, limit in failures:
+        print("CHECK FAILED: %s differs by %g (limit %g)" %
+              (description, diff, limit))
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    regressions = 0
+    for name, call in cases(paths, view_box):
+        if args.filter not in name:
+            continue
+        usec = time_call(call)
+        if name in baseline:
+            # Timing noise mostly makes things look slower, so make sure
+            for _ in range(RETRIES):
+                if usec <= baseline[name] * (1.0 + args.tolerance):
+                    break
+                usec = min(usec, time_call(call))
+        results[name] = usec
+        line = "%-58s %12.1f us" % (name, usec)
+        if name in baseline:
+            ratio = usec / baseline[name]
+            line += "  %5.2fx" % ratio
+            if ratio > 1.0 + args.tolerance:
+                line += "  REGRESSION"
+                regressions += 1
+            elif ratio < 1.0 - args.tolerance:
+                line += "  faster"
+        print(line)
+        sys.stdout.flush()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f,
+                      indent=2, sort_keys=True)
+        print("saved", args.save)
+    if regressions:
+        print("%d regression(s) against %s" % (regressions, args.compare))
+    if failures or regressions:
+        sys.exit(1)
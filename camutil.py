@@ -0,0 +1,616 @@
+"""Camera frame sources and motion detection for the eye server. Frame
+   sources all produce 8-bit grayscale (luma) frames at the processing
+   resolution, so the motion detection never has to convert or resize.
+   Moving blobs are followed from frame to frame by a centroid tracker.
+   Also an optional MJPEG stream of annotated frames, for debugging a
+   headless server."""
+
+from http.server import BaseHTTPRequestHandler
+import sys
+import threading
+import time
+import cv2
+import numpy as np
+from perfutil import ThreadingHTTPServer
+
+
+class FrameSource(object):
+    """Base class for frame sources. frames() is a generator of (height,
+       width) uint8 grayscale arrays at 'size' (width, height). Sources
+       may reuse the same array for every frame, so take a copy of any
+       frame that needs to outlive the next one.
+       If timer is set to a perfutil.FrameTimer, sources time their STAGES
+       (waiting for the frame counts as "capture")."""
+
+    STAGES = ("capture",)
+
+    def __init__(self, size):
+        self.size = size
+        self.timer = None
+
+    def frames(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PiCameraSource(FrameSource):
+    """Pi camera frames. The GPU scales the image to the processing size
+       and captures as YUV, and only the Y (luma) plane is used, so the
+       CPU never has to resize or convert color. Frames are captured into
+       one preallocated buffer."""
+
+    def __init__(self, size=(320, 240), resolution=(640, 480), framerate=30):
+        FrameSource.__init__(self, size)
+        from picamera import PiCamera # Only available on a Pi
+        self.camera = PiCamera(resolution=resolution, framerate=framerate)
+        # The camera pads YUV frames to a multiple of 32 x 16 pixels
+        width, height = size
+        padded_width = (width + 31) // 32 * 32
+        padded_height = (height + 15) // 16 * 16
+        self._buffer = np.empty(padded_width * padded_height * 3 // 2,
+                                dtype=np.uint8)
+        self._luma = self._buffer[:padded_width * padded_height].reshape(
+            padded_height, padded_width)[:height, :width]
+
+    def frames(self):
+        for _ in self.camera.capture_continuous(self._buffer, format="yuv",
+                                                use_video_port=True,
+                                                resize=self.size):
+            if self.timer is not None:
+                self.timer.lap("capture")
+            yield self._luma
+
+    def close(self):
+        self.camera.close()
+
+
+class VideoSource(FrameSource):
+    """Frames from a video file, or a camera device number (e.g. a USB
+       webcam), via OpenCV VideoCapture. Frames are converted to grayscale
+       and scaled to the processing size into preallocated buffers. If
+       'loop' is set a file is replayed forever."""
+
+    STAGES = ("capture", "convert", "resize")
+
+    def __init__(self, filename, size=(320, 240), loop=False):
+        FrameSource.__init__(self, size)
+        self.capture = cv2.VideoCapture(filename)
+        if not self.capture.isOpened():
+            raise IOError("can't open video source %r" % (filename,))
+        self.loop = loop
+        self._frame = None
+        self._gray = None
+        self._luma = np.empty((size[1], size[0]), dtype=np.uint8)
+
+    def frames(self):
+        while True:
+            timer = self.timer
+            ok, self._frame = self.capture.read(self._frame)
+            if not ok:
+                if self.loop and self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0):
+                    continue
+                return
+            if timer is not None:
+                timer.lap("capture")
+            self._gray = cv2.cvtColor(self._frame, cv2.COLOR_BGR2GRAY,
+                                      dst=self._gray)
+            if timer is not None:
+                timer.lap("convert")
+            if self._gray.shape == self._luma.shape:
+                yield self._gray
+            else:
+                cv2.resize(self._gray, self.size, dst=self._luma,
+                           interpolation=cv2.INTER_AREA)
+                if timer is not None:
+                    timer.lap("resize")
+                yield self._luma
+
+    def close(self):
+        self.capture.release()
+
+
+class SyntheticSource(FrameSource):
+    """Deterministic test frames: a noisy background with blobs moving
+       around and bouncing off the edges. The same seed always gives the
+       same frames, so the detection path (and everything downstream of
+       it) can be load tested and profiled on any machine. If framerate
+       is set, frames are paced like a camera; otherwise they are
+       produced as fast as possible. num_frames=None runs forever."""
+
+    def __init__(self, size=(320, 240), num_blobs=2, radius=None,
+                 framerate=None, num_frames=None, seed=0):
+        FrameSource.__init__(self, size)
+        width, height = size
+        rng = np.random.RandomState(seed)
+        if radius is None:
+            radius = max(height // 10, 2)
+        self.radius = radius
+        self.framerate = framerate
+        self.num_frames = num_frames
+        self.positions = rng.uniform((radius, radius),
+                                     (width - radius, height - radius),
+                                     (num_blobs, 2))
+        # Pixels per frame; a blob crosses the frame in a second or two
+        self.velocities = (rng.uniform(-1.0, 1.0, (num_blobs, 2)) *
+                           width / 45.0)
+        self.brightness = rng.randint(160, 256, num_blobs).tolist()
+        self._noise = [rng.randint(40, 60, (height, width)).astype(np.uint8)
+                       for _ in range(4)]
+        self._frame = np.empty((height, width), dtype=np.uint8)
+
+    def _move(self):
+        self.positions += self.velocities
+        limit = np.array(self.size, dtype=float) - self.radius
+        for axis in range(2):
+            low = self.positions[:, axis] < self.radius
+            high = self.positions[:, axis] > limit[axis]
+            self.velocities[low | high, axis] *= -1.0
+            np.clip(self.positions[:, axis], self.radius, limit[axis],
+                    out=self.positions[:, axis])
+
+    def frames(self):
+        frame_num = 0
+        next_time = time.time()
+        while self.num_frames is None or frame_num < self.num_frames:
+            self._frame[:] = self._noise[frame_num % len(self._noise)]
+            for (x, y), level in zip(self.positions.tolist(),
+                                     self.brightness):
+                cv2.circle(self._frame, (int(x), int(y)), self.radius, level,
+                           -1)
+            if self.framerate:
+                next_time += 1.0 / self.framerate
+                delay = next_time - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            if self.timer is not None:
+                self.timer.lap("capture")
+            yield self._frame
+            self._move()
+            frame_num += 1
+
+
+def open_frame_source(kind, size, resolution=(640, 480), framerate=30,
+                      video=0):
+    """Create a frame source by name: "picamera", "video" (a file name
+       or camera device number given by 'video') or "synthetic"."""
+    if kind == "picamera":
+        return PiCameraSource(size, resolution, framerate)
+    if kind == "video":
+        return VideoSource(video, size, loop=not isinstance(video, int))
+    if kind == "synthetic":
+        return SyntheticSource(size, framerate=framerate)
+    raise ValueError("unknown frame source %r" % (kind,))
+
+
+class MotionDetector(object):
+    """Running average background subtraction: blur, accumulate weighted
+       average, difference, threshold, dilate, then contours. All of the
+       intermediate images are allocated once, at the processing size.
+       The blur kernel and minimum contour area default to the values
+       originally used on 500 pixel wide frames (21 and 5000), scaled to
+       the processing size.
+       If tiles is given as (columns, rows), detection is incremental: a
+       heavily downscaled copy of each frame is compared against its own
+       running average to find which tiles have changed, and the full
+       resolution pipeline only runs over those tiles and their
+       neighbours (nothing at all runs if no tile has changed). Every
+       resync_interval frames a full frame pass is done to bring the
+       whole background model up to date.
+       If timer is set to a perfutil.FrameTimer, each of STAGES is timed
+       (summed over all the tiles processed in a frame)."""
+
+    STAGES = ("tiles", "blur", "accumulate", "threshold", "contours")
+
+    def __init__(self, size, alpha=0.5, delta_thresh=5, blur=None,
+                 min_area=None, tiles=None, resync_interval=30):
+        width, height = size
+        scale = width / 500.0
+        if blur is None:
+            blur = max(int(21 * scale) | 1, 3) # Must be odd
+        if min_area is None:
+            min_area = 5000 * scale * scale
+        self.size = size
+        self.alpha = alpha
+        self.delta_thresh = delta_thresh
+        self.blur = (blur, blur)
+        self.min_area = min_area
+        self.avg = None
+        self.gray = np.empty((height, width), dtype=np.uint8)
+        self.avg_u8 = np.empty((height, width), dtype=np.uint8)
+        self.delta = np.empty((height, width), dtype=np.uint8)
+        self.thresh = np.empty((height, width), dtype=np.uint8)
+        self.dilated = np.empty((height, width), dtype=np.uint8)
+        self.prev_dilated = np.zeros((height, width), dtype=np.uint8)
+        self.roi_tolerance = 0.02
+        self.skipped = 0
+        self.timer = None
+        self._last_roi = None
+        self._last_boxes = []
+
+        self.tiles = tiles
+        self.resync_interval = resync_interval
+        self.frame_num = 0
+        if tiles is not None:
+            # 4x4 samples per tile in the downscaled copy
+            self._small = np.empty((tiles[1] * 4, tiles[0] * 4),
+                                   dtype=np.uint8)
+            self._small_avg = None
+            self._small_avg_u8 = np.empty_like(self._small)
+            self._small_delta = np.empty_like(self._small)
+            # Rectangles must take in enough around the tiles for the blur
+            # and dilation to see the same pixels as a full frame pass
+            self._margin = blur // 2 + 2
+
+    def reset(self):
+        """Start the background model again from the next frame."""
+        self.avg = None
+        if self.tiles is not None:
+            self._small_avg = None
+
+    def _roi_unchanged(self, roi):
+        """True if all motion is inside roi, and the motion mask inside it
+           is (nearly) the same as when boxes were last found."""
+        if roi != self._last_roi:
+            return False
+        x, y, w, h = roi
+        mask = self.dilated[y:y + h, x:x + w]
+        if cv2.countNonZero(mask) != cv2.countNonZero(self.dilated):
+            return False # Something is moving elsewhere too
+        prev = self.prev_dilated[y:y + h, x:x + w]
+        changed = cv2.countNonZero(cv2.absdiff(mask, prev))
+        return changed <= self.roi_tolerance * w * h
+
+    def _dirty_rects(self, frame):
+        """Update the downscaled background model and return a list of
+           (x, y, w, h) pixel rectangles covering the changed tiles and
+           their neighbours."""
+        columns, rows = self.tiles
+        cv2.resize(frame, (columns * 4, rows * 4), dst=self._small,
+                   interpolation=cv2.INTER_AREA)
+        if self._small_avg is None:
+            self._small_avg = self._small.astype(np.float32)
+        cv2.accumulateWeighted(self._small, self._small_avg, self.alpha)
+        cv2.convertScaleAbs(self._small_avg, dst=self._small_avg_u8)
+        cv2.absdiff(self._small, self._small_avg_u8, dst=self._small_delta)
+        tile_change = self._small_delta.reshape(rows, 4, columns, 4).max(
+            axis=(1, 3))
+        dirty = (tile_change > self.delta_thresh).astype(np.uint8)
+        if not dirty.any():
+            return []
+        dirty = cv2.dilate(dirty, np.ones((3, 3), np.uint8))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(dirty,
+                                                              connectivity=8)
+        width, height = self.size
+        tile_w = width / float(columns)
+        tile_h = height / float(rows)
+        rects = []
+        for tx, ty, tw, th, _ in stats[1:count].tolist():
+            x0 = max(int(tx * tile_w) - self._margin, 0)
+            y0 = max(int(ty * tile_h) - self._margin, 0)
+            x1 = min(int((tx + tw) * tile_w) + self._margin, width)
+            y1 = min(int((ty + th) * tile_h) + self._margin, height)
+            rects.append((x0, y0, x1 - x0, y1 - y0))
+        return rects
+
+    def _mask(self, frame, rect):
+        """Run the full resolution pipeline up to the dilated motion mask
+           over one rectangle of the frame."""
+        x, y, w, h = rect
+        timer = self.timer
+        region = (slice(y, y + h), slice(x, x + w))
+        gray = self.gray[region]
+        avg_u8 = self.avg_u8[region]
+        delta = self.delta[region]
+        thresh = self.thresh[region]
+        cv2.GaussianBlur(frame[region], self.blur, 0, dst=gray)
+        if timer is not None:
+            timer.lap("blur")
+
+        # accumulate the weighted average between the current frame and
+        # previous frames, then compute the difference between the current
+        # frame and running average
+        cv2.accumulateWeighted(gray, self.avg[region], self.alpha)
+        cv2.convertScaleAbs(self.avg[region], dst=avg_u8)
+        cv2.absdiff(gray, avg_u8, dst=delta)
+        if timer is not None:
+            timer.lap("accumulate")
+
+        # threshold the delta image, dilate the thresholded image to fill
+        # in holes, then find contours on thresholded image
+        cv2.threshold(delta, self.delta_thresh, 255, cv2.THRESH_BINARY,
+                      dst=thresh)
+        cv2.dilate(thresh, None, dst=self.dilated[region], iterations=2)
+        if timer is not None:
+            timer.lap("threshold")
+
+    def _contours(self, rect):
+        """Find the contours of the motion mask in one rectangle."""
+        x, y, w, h = rect
+        # OpenCV 3 returns (image, contours, hierarchy), 4 doesn't
+        return cv2.findContours(self.dilated[y:y + h, x:x + w],
+                                cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                offset=(x, y))[-2]
+
+    def detect(self, frame, roi=None):
+        """Process one grayscale frame, returning a list of (x, y, w, h)
+           bounding boxes of moving areas at least min_area in size.
+           If the (x, y, w, h) roi of a tracked target is given, and the
+           motion in and around it hasn't changed since the last full
+           analysis, the contour analysis is skipped and the last boxes
+           are returned again."""
+        self.frame_num += 1
+        full_frame = (0, 0, self.size[0], self.size[1])
+        rects = [full_frame]
+        if self.tiles is not None:
+            dirty = self._dirty_rects(frame)
+            if self.timer is not None:
+                self.timer.lap("tiles")
+            if (self.avg is not None and
+                    self.frame_num % self.resync_interval != 0):
+                rects = dirty
+                self.dilated[:] = 0
+
+        # if the average frame is None, initialize it
+        if self.avg is None:
+            cv2.GaussianBlur(frame, self.blur, 0, dst=self.gray)
+            self.avg = self.gray.astype(np.float32)
+            if self.timer is not None:
+                self.timer.lap("blur")
+            return []
+
+        for rect in rects:
+            self._mask(frame, rect)
+        if roi is not None and self._roi_unchanged(roi):
+            self.skipped += 1
+            boxes = self._last_boxes
+        else:
+            cnts = []
+            for rect in rects:
+                cnts.extend(self._contours(rect))
+            boxes = [cv2.boundingRect(c) for c in cnts
+                     if cv2.contourArea(c) >= self.min_area]
+            if roi is not None:
+                np.copyto(self.prev_dilated, self.dilated)
+            self._last_roi = roi
+            self._last_boxes = boxes
+        if self.timer is not None:
+            self.timer.lap("contours")
+        return boxes
+
+
+class Track(object):
+    """One moving blob followed by CentroidTracker."""
+
+    def __init__(self, track_id, box, frame_num):
+        self.track_id = track_id
+        self.first_seen = frame_num
+        self.missed = 0
+        self.set_box(box)
+
+    def set_box(self, box):
+        x, y, w, h = box
+        self.box = box
+        self.centroid = (x + w / 2.0, y + h / 2.0)
+        self.area = w * h
+
+
+class CentroidTracker(object):
+    """Gives moving blobs persistent IDs from frame to frame, by matching
+       each new bounding box to the nearest existing track centroid
+       (within max_distance pixels), and picks one of them as the target
+       for the eyes to look at. Policies are "largest", "oldest" (longest
+       lived) or "nearest" (to the gaze point passed to update(), i.e.
+       where the eyes are looking, in frame pixels; without one, nearest
+       the previous target). To stop the eyes twitching between blobs, the target
+       is kept for as long as it's seen, except that with "largest" a
+       blob switch_ratio times bigger takes over. Tracks not seen for
+       max_missed frames are dropped."""
+
+    POLICIES = ("largest", "oldest", "nearest")
+
+    def __init__(self, policy="largest", max_distance=80.0, max_missed=5,
+                 switch_ratio=2.0):
+        if policy not in self.POLICIES:
+            raise ValueError("unknown tracking policy %r" % (policy,))
+        self.policy = policy
+        self.max_distance = max_distance
+        self.max_missed = max_missed
+        self.switch_ratio = switch_ratio
+        self.tracks = []
+        self.target = None
+        self.frame_num = 0
+        self._next_id = 0
+
+    def _associate(self, boxes):
+        """Match boxes to tracks, nearest pairs first. Returns the boxes
+           not matched to any track."""
+        if not self.tracks:
+            return list(boxes)
+        if not boxes:
+            for track in self.tracks:
+                track.missed += 1
+            return []
+        old = np.array([t.centroid for t in self.tracks])
+        new = np.array([(x + w / 2.0, y + h / 2.0) for x, y, w, h in boxes])
+        dist = np.hypot(old[:, None, 0] - new[None, :, 0],
+                        old[:, None, 1] - new[None, :, 1])
+        used_tracks = set()
+        used_boxes = set()
+        for flat in np.argsort(dist, axis=None).tolist():
+            track_num, box_num = divmod(flat, len(boxes))
+            if dist[track_num, box_num] > self.max_distance:
+                break
+            if track_num in used_tracks or box_num in used_boxes:
+                continue
+            used_tracks.add(track_num)
+            used_boxes.add(box_num)
+            self.tracks[track_num].set_box(boxes[box_num])
+            self.tracks[track_num].missed = 0
+        for track_num, track in enumerate(self.tracks):
+            if track_num not in used_tracks:
+                track.missed += 1
+        return [box for box_num, box in enumerate(boxes)
+                if box_num not in used_boxes]
+
+    def _choose(self, visible, gaze=None):
+        if self.policy == "largest":
+            return max(visible, key=lambda t: t.area)
+        if self.policy == "oldest":
+            return min(visible, key=lambda t: t.first_seen)
+        if gaze is not None:
+            tx, ty = gaze
+        elif self.target is not None:
+            tx, ty = self.target.centroid
+        else:
+            return max(visible, key=lambda t: t.area)
+        return min(visible, key=lambda t: (t.centroid[0] - tx) ** 2 +
+                   (t.centroid[1] - ty) ** 2)
+
+    def update(self, boxes, gaze=None):
+        """Update tracks with this frame's bounding boxes and return the
+           target Track, or None if nothing is moving. 'gaze' is the (x,
+           y) point in the frame the eyes are looking at, used by the
+           "nearest" policy."""
+        self.frame_num += 1
+        for box in self._associate(boxes):
+            self.tracks.append(Track(self._next_id, box, self.frame_num))
+            self._next_id += 1
+        self.tracks = [t for t in self.tracks if t.missed <= self.max_missed]
+
+        visible = [t for t in self.tracks if t.missed == 0]
+        if not visible:
+            self.target = None
+            return None
+        if self.target is None or self.target.missed > 0:
+            self.target = self._choose(visible, gaze)
+        elif self.policy == "largest":
+            largest = self._choose(visible)
+            if largest.area > self.target.area * self.switch_ratio:
+                self.target = largest
+        return self.target
+
+    def target_roi(self, size, pad=0.5):
+        """Return the target's box expanded by pad (as a fraction of its
+           size) on each side and clipped to a frame of size (width,
+           height), or None if there is no target."""
+        if self.target is None:
+            return None
+        x, y, w, h = self.target.box
+        x0 = max(int(x - w * pad), 0)
+        y0 = max(int(y - h * pad), 0)
+        x1 = min(int(x + w * (1.0 + pad)), size[0])
+        y1 = min(int(y + h * (1.0 + pad)), size[1])
+        return (x0, y0, x1 - x0, y1 - y0)
+
+
+def draw_boxes(frame, boxes, target=None):
+    """Return a copy of a frame with bounding boxes drawn on it, and the
+       target box (if any) drawn thicker."""
+    frame = frame.copy()
+    for (x, y, w, h) in boxes:
+        cv2.rectangle(frame, (x, y), (x + w, y + h), 255, 2)
+    if target is not None:
+        (x, y, w, h) = target
+        cv2.rectangle(frame, (x, y), (x + w, y + h), 255, 5)
+    return frame
+
+
+class _MJPEGHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        stream = self.server.stream
+        self.send_response(200)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Content-Type",
+                         "multipart/x-mixed-replace; boundary=frame")
+        self.end_headers()
+        with stream.condition:
+            stream.viewers += 1
+        try:
+            jpeg = None
+            while True:
+                with stream.condition:
+                    while stream.jpeg is jpeg:
+                        stream.condition.wait()
+                    jpeg = stream.jpeg
+                self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\n"
+                                 b"Content-Length: %d\r\n\r\n" % len(jpeg))
+                self.wfile.write(jpeg)
+                self.wfile.write(b"\r\n")
+        except OSError:
+            pass # Viewer went away
+        finally:
+            with stream.condition:
+                stream.viewers -= 1
+
+    def log_message(self, *args):
+        pass # Keep the server console quiet
+
+
+class MJPEGStream(object):
+    """Serves annotated frames as an MJPEG stream over HTTP (view at
+       http://host:port/ in a browser), for a server that is normally run
+       headless. Frames are only JPEG encoded while someone is watching,
+       and at no more than 'rate' frames per second; call wanted() first
+       to avoid even preparing a frame otherwise."""
+
+    def __init__(self, port, host="127.0.0.1", rate=5):
+        self.interval = 1.0 / rate
+        self.last_time = 0.0
+        self.viewers = 0
+        self.jpeg = None
+        self.condition = threading.Condition()
+        self.httpd = ThreadingHTTPServer((host, port), _MJPEGHandler)
+        self.httpd.stream = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name="MJPEGStream", daemon=True)
+        self.thread.start()
+
+    def wanted(self, now):
+        """True if a viewer is connected and a frame is due."""
+        return self.viewers > 0 and now - self.last_time >= self.interval
+
+    def publish(self, frame, now):
+        """Encode a frame and send it to all viewers."""
+        self.last_time = now
+        ok, jpeg = cv2.imencode(".jpg", frame)
+        if ok:
+            with self.condition:
+                self.jpeg = jpeg.tobytes()
+                self.condition.notify_all()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def benchmark(source, detector, num_frames=300):
+    """Run the motion detection over frames from a source, returning the
+       average frames per second."""
+    frames = 0
+    start = time.time()
+    for frame in source.frames():
+        detector.detect(frame)
+        frames += 1
+        if frames >= num_frames:
+            break
+    return frames / (time.time() - start)
+
+
+if __name__ == "__main__":
+    # Benchmark motion detection without a camera:
+    # python3 camutil.py video_file|synthetic [width height]
+    if len(sys.argv) < 2:
+        print("usage: python3 camutil.py video_file|synthetic [width height]")
+        sys.exit(1)
+    SIZE = (320, 240)
+    if len(sys.argv) >= 4:
+        SIZE = (int(sys.argv[2]), int(sys.argv[3]))
+    if sys.argv[1] == "synthetic":
+        SOURCE = SyntheticSource(SIZE)
+    else:
+        SOURCE = VideoSource(sys.argv[1], SIZE, loop=True)
+    print("%.1f fps at %dx%d" % (benchmark(SOURCE, MotionDetector(SIZE)),
+                                 SIZE[0], SIZE[1]))
+    SOURCE.close()
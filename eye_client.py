@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+# Network crazy eyes : Client
+#
+# A remix of:
+#
+# Adafruit / Phillip Burgess (Paint Your Dragon)'s Animated Snake Eyes for Raspberry Pi
+# https://learn.adafruit.com/animated-snake-eyes-bonnet-for-raspberry-pi/software-installation
+# https://github.com/adafruit/Pi_Eyes
+#
+# Nathan Jennings / Real Python guide to Socket Programming in Python (Guide)
+# https://realpython.com/python-sockets/#handling-multiple-connections
+# https://github.com/realpython/materials/blob/master/python-sockets-tutorial/multiconn-client.py
+
+# This renders a single left or right eye (centered on screen), or both
+# eyes side by side on one display, and assumes you are using HDMI for
+# display:
+#   python3 eye_client.py --side left|right|both
+
+import argparse
+import time
+import socket
+import pi3d
+from eyemodel import EyeModel
+from eyerender import EyeAssets, EyePair, EyeRenderer
+from netutil import MULTICAST_GROUP, ConnectionManager, StateBuffer
+from perfutil import FrameTimer, StatsServer, format_summary
+
+# Get my IP address
+hostname = socket.gethostname()
+host = socket.gethostbyname(hostname)
+host = '127.0.0.1' # Uncomment this line for local testing
+#host = '' # Listen on all available interfaces
+
+# Use this port (make sure the eye server is using the same one!)
+port = 65432
+
+# The server's address is remembered here, to reconnect quickly next time
+SERVER_CACHE = ".eye_server"
+
+# Set MULTICAST to receive the eye state over UDP multicast instead of
+# connecting to the server (the server must have MULTICAST set too)
+MULTICAST       = False
+multicastGroup  = MULTICAST_GROUP
+multicastPort   = 65433
+
+SIDE            = "left" # Which eye to render: "left", "right" or "both"
+TRACKING        = True  # If True, eyelid tracks pupil
+IRIS_CACHE_SIZE = None  # None = precompute all iris meshes at startup,
+                        # else keep this many in an LRU cache
+LID_CACHE_SIZE  = 512   # Number of eyelid meshes kept in each LRU cache
+INTERP_DELAY    = None  # Seconds to render behind the server, so movement
+                        # can be interpolated; None = adapt to update rate
+AUTONOMOUS      = True  # If True, move the eye locally while the server is
+                        # unreachable; if False, hold the last state
+
+# Frame timing (network, iris and eyelid regeneration, draw and buffer swap
+# times) can be printed every STATS_INTERVAL seconds, and/or served as JSON
+# at http://127.0.0.1:STATS_PORT/ (None to disable either)
+STATS_INTERVAL  = None
+STATS_PORT      = None
+
+parser = argparse.ArgumentParser(description="Network crazy eyes client")
+parser.add_argument("--side", choices=("left", "right", "both"),
+	default=SIDE, help="which eye to render, or both side by side")
+parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+	metavar="SECONDS", help="print frame timing stats this often")
+parser.add_argument("--stats-port", type=int, default=STATS_PORT,
+	metavar="PORT", help="serve frame timing stats as JSON on this port")
+args = parser.parse_args()
+
+# Set up display and initialize pi3d ---------------------------------------
+
+#DISPLAY = pi3d.Display.create(samples=4, w=640, h=480)
+DISPLAY = pi3d.Display.create(samples=4, w=1280, h=720)
+#DISPLAY = pi3d.Display.create(samples=4, w=1920, h=1080)
+#DISPLAY = pi3d.Display.create(samples=4)
+DISPLAY.set_background(0, 0, 0, 1) # r,g,b,alpha
+
+# eyeRadius is the size, in pixels, at which the whole eye will be rendered.
+if DISPLAY.width <= (DISPLAY.height * 2):
+	# For WorldEye, eye size is -almost- full screen height
+	eyeRadius   = DISPLAY.height / 2.1
+else:
+	eyeRadius   = DISPLAY.height * 2 / 5
+# With both eyes, each is centered in its half of the screen
+eyePosition = DISPLAY.width / 4
+if args.side == "both":
+	eyeRadius = min(eyeRadius, DISPLAY.width / 4.2)
+
+# A 2D camera is used, mostly to allow for pixel-accurate eye placement,
+# but also because perspective isn't really helpful or needed here, and
+# also this allows eyelids to be handled somewhat easily as 2D planes.
+# Line of sight is down Z axis, allowing conventional X/Y cartesion
+# coords for 2D positions.
+cam    = pi3d.Camera(is_3d=False, at=(0,0,0), eye=(0,0,-1000))
+light  = pi3d.Light(lightpos=(0, -500, -500), lightamb=(0.2, 0.2, 0.2))
+
+# Textures, shader and geometry are loaded once and shared by both eyes
+assets = EyeAssets(eyeRadius, "graphics/eye.svg", IRIS_CACHE_SIZE,
+	LID_CACHE_SIZE)
+if args.side == "both":
+	# Both eyes share their geometry, which is worked out once per frame
+	eyes = [EyePair(assets, eyePosition, TRACKING)]
+else:
+	eyes = [EyeRenderer(assets, args.side, 0.0, TRACKING)]
+
+#mykeys = pi3d.Keyboard() # For capturing key presses
+
+# Per-frame stage times, kept for the last 1024 frames
+timer = None
+statsServer = None
+statsTime = time.monotonic()
+if args.stats_interval or args.stats_port:
+	timer = FrameTimer(("swap", "net", "iris", "lid", "draw"))
+if args.stats_port:
+	statsServer = StatsServer(args.stats_port, timer.summary)
+	print("frame stats on port", args.stats_port)
+
+# These are the settings shared by (read from) the server
+shared = {"curX":0.0, "curY":0.0, "pupil":0.5, "lid":0.0, "blink":0}
+# Received states are buffered and interpolated at render time
+stateBuffer = StateBuffer(INTERP_DELAY)
+# Local eye model, used while there's no server
+localModel = EyeModel()
+
+# Generate one frame of imagery
+def frame():
+
+	global shared
+	global statsTime
+
+	if timer is not None:
+		timer.next_frame()
+
+	# Swaps the buffers drawn last frame, so this also waits for the GPU
+	DISPLAY.loop_running()
+	if timer is not None:
+		timer.lap("swap")
+
+	now = time.monotonic()
+
+	if AUTONOMOUS and not connection.alive(now):
+		shared = localModel.update(now)
+	else:
+		state = stateBuffer.sample(now)
+		if state is not None:
+			shared = state
+	if timer is not None:
+		timer.lap("net")
+
+	for eye in eyes:
+		eye.update(shared, timer)
+	for eye in eyes:
+		eye.draw()
+	if timer is not None:
+		timer.lap("draw")
+
+	if args.stats_interval and now - statsTime >= args.stats_interval:
+		statsTime = now
+		print(format_summary(timer.summary()))
+
+
+# The connection manager finds the server (trying the last known address
+# first), reconnects with backoff if it stops sending, and passes every
+# received state to the jitter buffer. It runs in its own thread, so the
+# render loop never waits on the network; each frame just samples the
+# latest snapshot from the jitter buffer.
+if MULTICAST:
+	print("Listening for multicast on", (multicastGroup, multicastPort))
+	connection = ConnectionManager(stateBuffer.push,
+		multicast=(multicastGroup, multicastPort))
+else:
+	connection = ConnectionManager(stateBuffer.push, host, int(port),
+		SERVER_CACHE)
+connection.start()
+
+# MAIN LOOP -- runs continuously -------------------------------------------
+
+try:
+	while True:
+		frame()
+
+except KeyboardInterrupt:
+	print("caught keyboard interrupt, exiting")
+
+finally:
+	DISPLAY.stop()
+	connection.close()
+	if statsServer is not None:
+		statsServer.close()
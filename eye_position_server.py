@@ -23,18 +23,16 @@
 # due to an issue with OpenCV 4.1.1.26
 # LD_PRELOAD=/usr/lib/arm-linux-gnueabihf/libatomic.so.1 python3 eye_position_server.py
 
-import math
-import random
+import argparse
 import time
 import socket
-import selectors
-import types
-import pickle
 import cv2
-import imutils # https://github.com/jrosebr1/imutils/
-from picamera.array import PiRGBArray
-from picamera import PiCamera
-import datetime
+from camutil import (CentroidTracker, MJPEGStream, MotionDetector, draw_boxes,
+	open_frame_source)
+from eyemodel import EyeModel
+from gazecal import GazeMapper, load_calibration
+from netutil import MULTICAST_GROUP, DiscoveryResponder, StatePublisher
+from perfutil import FrameTimer, JSONLinesLog, format_summary
 
 # Get my IP address
 hostname = socket.gethostname()
@@ -45,231 +43,232 @@ host = '127.0.0.1' # Uncomment this line for local testing
 # Use this port (make sure the eye clients are using the same one!)
 port = 65432
 
+PUBLISH_RATE    = 60    # Eye state updates sent to the clients per second
+
+# Set MULTICAST to also send each state update once over UDP, for any
+# number of clients (make sure the eye clients are using the same group
+# and port!). A broadcast address such as 192.168.0.255 also works.
+MULTICAST       = False
+multicastGroup  = MULTICAST_GROUP
+multicastPort   = 65433
+
+DISCOVERY       = True  # If True, answer the eye clients' who-is queries
+
 PUPIL_SMOOTH    = 16    # If > 0, filter input from PUPIL_IN
 PUPIL_MIN       = 0.0   # Lower analog range from PUPIL_IN
 PUPIL_MAX       = 1.0   # Upper "
 
-startX       = random.uniform(-30.0, 30.0)
-n            = math.sqrt(900.0 - startX * startX)
-startY       = random.uniform(-n, n)
-destX        = startX
-destY        = startY
-curX         = startX
-curY         = startY
-moveDuration = random.uniform(0.075, 0.175)
-holdDuration = random.uniform(0.1, 1.1)
-startTime    = 0.0
-isMoving     = False
-currentPupilScale  =  0.5
-lidWeight    = 0.0
-
 AUTOBLINK       = True  # If True, eye blinks autonomously
 
-timeOfLastBlink = 0.0
-timeToNextBlink = 1.0
-blinkState      = 0
-blinkDuration   = 0.1
-blinkStartTime  = 0
-blinkState 	    = 0
+# Where frames come from: "picamera", "video" (VIDEO_SOURCE is a file name,
+# or a device number for a USB camera) or "synthetic" (moving test blobs,
+# for testing without a camera). Can be overridden on the command line.
+FRAME_SOURCE      = "picamera"
+VIDEO_SOURCE      = 0
+
+# The camera captures at CAMERA_RESOLUTION, and the GPU scales this down to
+# PROCESS_SIZE for motion detection. Smaller is faster.
+CAMERA_RESOLUTION = (640, 480)
+CAMERA_FRAMERATE  = 30
+PROCESS_SIZE      = (320, 240)
+
+# Motion detection only reprocesses the parts of the frame that have
+# changed, found by splitting it into MOTION_TILES (columns, rows); a full
+# frame pass is still made every MOTION_RESYNC frames. None to always
+# process the whole frame. Each moving blob still takes in the tiles
+# around it (about a quarter of the frame at 8x6), so the saving is
+# modest: roughly 1.2x to 1.7x with one blob moving.
+MOTION_TILES      = (8, 6)
+MOTION_RESYNC     = 30
+
+# When several things are moving, which one the eyes follow: "largest",
+# "oldest" (seen for longest) or "nearest" (to where the eyes are looking)
+TRACK_POLICY      = "largest"
+
+# Mapping from camera position to eye angle, fitted with gazecal.py. If
+# the file doesn't exist the image is mapped linearly onto +/-30.
+GAZE_CALIBRATION  = "gaze_calibration.json"
+
+# If HEADLESS, don't show or annotate the camera image at all. The
+# annotated image can instead be watched in a browser at
+# http://127.0.0.1:DEBUG_STREAM_PORT/ (None to disable), at a reduced
+# rate, and only costs anything while someone is watching.
+HEADLESS          = False
+DEBUG_STREAM_PORT = None
+DEBUG_STREAM_RATE = 5
 
-# These are the settings shared with (written to) the client
-shared = {"curX":curX, "curY":curY, "pupil":currentPupilScale, "lid":lidWeight, "blink":blinkState}
+# If PROFILE, time each stage of the camera pipeline and of the state
+# publisher (and each client's send latency and backlog), and print a
+# report every PROFILE_INTERVAL seconds. The full figures, with
+# histograms, are also appended to PROFILE_LOG as JSON lines (None for
+# no file).
+PROFILE           = False
+PROFILE_INTERVAL  = 5.0
+PROFILE_LOG       = None
 
-sel = selectors.DefaultSelector()
+parser = argparse.ArgumentParser(description="Network crazy eyes server")
+parser.add_argument("--source", choices=("picamera", "video", "synthetic"),
+	default=FRAME_SOURCE, help="frame source for motion detection")
+parser.add_argument("--video", default=VIDEO_SOURCE,
+	help="video file or camera device number for --source video")
+parser.add_argument("--track", choices=CentroidTracker.POLICIES,
+	default=TRACK_POLICY, help="which moving target the eyes follow")
+parser.add_argument("--headless", action="store_true", default=HEADLESS,
+	help="don't display the camera image")
+parser.add_argument("--debug-stream", type=int, default=DEBUG_STREAM_PORT,
+	metavar="PORT", help="serve annotated frames as MJPEG on this port")
+parser.add_argument("--calibration", default=GAZE_CALIBRATION,
+	metavar="FILE", help="camera to eye angle calibration file")
+parser.add_argument("--print-target", action="store_true",
+	help="print the tracked target's camera position, for calibration")
+parser.add_argument("--profile", action="store_true", default=PROFILE,
+	help="time the pipeline stages and print a report periodically")
+parser.add_argument("--profile-interval", type=float,
+	default=PROFILE_INTERVAL, metavar="SECONDS",
+	help="seconds between profile reports")
+parser.add_argument("--profile-log", default=PROFILE_LOG, metavar="FILE",
+	help="also append profile reports to FILE as JSON lines")
+args = parser.parse_args()
+if isinstance(args.video, str) and args.video.isdigit():
+	args.video = int(args.video)
+
+# The eye position, pupil and blink model runs in the publisher thread at
+# PUBLISH_RATE; the camera loop below only feeds it motion targets.
+eyeModel = EyeModel(AUTOBLINK, PUPIL_MIN, PUPIL_MAX)
 
 lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 lsock.bind((host, port))
 lsock.listen()
 print("listening on", (host, port))
-lsock.setblocking(False)
-sel.register(lsock, selectors.EVENT_READ, data=None)
+if MULTICAST:
+	print("multicasting to", (multicastGroup, multicastPort))
+	publisher = StatePublisher(lsock, PUBLISH_RATE, eyeModel.update,
+		(multicastGroup, multicastPort))
+else:
+	publisher = StatePublisher(lsock, PUBLISH_RATE, eyeModel.update)
+publisher.start()
+if DISCOVERY:
+	discovery = DiscoveryResponder(lsock.getsockname())
+	discovery.start()
+
+# initialize the camera; frames arrive as grayscale at PROCESS_SIZE
+source = open_frame_source(args.source, PROCESS_SIZE, CAMERA_RESOLUTION,
+	CAMERA_FRAMERATE, args.video)
+detector = MotionDetector(PROCESS_SIZE, tiles=MOTION_TILES,
+	resync_interval=MOTION_RESYNC)
+tracker = CentroidTracker(args.track, max_distance=PROCESS_SIZE[0] / 4.0)
+debugStream = None
+if args.debug_stream:
+	debugStream = MJPEGStream(args.debug_stream, rate=DEBUG_STREAM_RATE)
+	print("debug stream on port", args.debug_stream)
+#source.camera.start_preview() # only used for testing / alignment (picamera)
+#time.sleep(5)
 
-def accept_wrapper(sock):
-	conn, addr = sock.accept()  # Should be ready to read
-	print("accepted connection from", addr)
-	conn.setblocking(False)
-	data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
-	events = selectors.EVENT_WRITE # | selectors.EVENT_READ
-	sel.register(conn, events, data=data)
+# Camera position to eye angle lookup table for PROCESS_SIZE
+gaze = GazeMapper(load_calibration(args.calibration), PROCESS_SIZE)
 
-def service_connection(key, mask, shared):
-	sock = key.fileobj
-	data = key.data
-#	if mask & selectors.EVENT_READ:
-#		recv_data = sock.recv(3)  # Should be ready to read
-#		data.inb = recv_data
-#		if recv_data: # Did we receive any data?
-#			print("received", repr(recv_data), "from address", data.addr)
-#			if recv_data != b"???": # The client should only ever send "???"
-#				print("closing connection to", data.addr)
-#				sel.unregister(sock)
-#				sock.close()
-	if mask & selectors.EVENT_WRITE:
-		data.outb = pickle.dumps(shared) # pickle the shared variables
-		#print("echoing", len(data.outb), "bytes to", data.addr)
-		sent = sock.send(data.outb)  # Should be ready to write
+# Pipeline profiling: the frame source, motion detector and publisher
+# time their own stages; the loop below times the rest
+cameraTimer = None
+profileLog = None
+if args.profile or args.profile_log:
+	cameraTimer = FrameTimer(source.STAGES + detector.STAGES +
+		("track", "display", "gaze"))
+	source.timer = cameraTimer
+	detector.timer = cameraTimer
+	publisher.timer = FrameTimer(("model", "send"))
+	if args.profile_log:
+		profileLog = JSONLinesLog(args.profile_log)
 
-# initialize the camera and grab a reference to the raw camera capture
-camera = PiCamera()
-camera.resolution = (640, 480)
-camera.framerate = 5
-rawCapture = PiRGBArray(camera, size=(640, 480))
-#camera.start_preview() # only used for testing / alignment
-#time.sleep(5)
+def reportProfile(now):
+	camera = cameraTimer.summary(histogram=True)
+	publish = publisher.timer.summary(histogram=True)
+	clients = publisher.client_stats()
+	print("[PROFILE] camera:", format_summary(camera, skip_idle=True))
+	print("[PROFILE] publish:", format_summary(publish))
+	for addr, stats in clients.items():
+		latency = stats["latency"]
+		if latency is not None:
+			latency = "%.2f/%.2f/%.2f ms" % (latency["p50"],
+				latency["p95"], latency["p99"])
+		print("[PROFILE] client %s: sent %d, skipped %d, backlog %d"
+			" (unsent %s), latency %s" % (addr, stats["sent"],
+			stats["skipped"], stats["backlog"], stats["unsent"], latency))
+	if profileLog is not None:
+		profileLog.write({"time": now, "camera": camera, "publish": publish,
+			"clients": clients, "roi_skipped": detector.skipped})
 
-# allow the camera to warmup, then initialize the average frame
+# allow the camera to warmup
 print("[INFO] warming up...")
 time.sleep(2.5)
-avg = None
+profileTime = time.time()
 
 try:
-	while True:
+	# Motion Detection
+	# capture frames from the camera
+	if cameraTimer is not None:
+		cameraTimer.next_frame()
+	for frame in source.frames():
+		if detector.avg is None:
+			print("[INFO] starting background model...")
+		# Once a target is being tracked, contour analysis can be
+		# skipped while nothing around it changes
+		boxes = detector.detect(frame, tracker.target_roi(PROCESS_SIZE))
+		gazePoint = None
+		if args.track == "nearest":
+			# Where the eyes are looking now, in frame pixels
+			gazePoint = gaze.locate(eyeModel.cur_x, eyeModel.cur_y)
+		target = tracker.update(boxes, gazePoint)
+		targetBox = target.box if target is not None else None
+		now = time.time()
+		if cameraTimer is not None:
+			cameraTimer.lap("track")
 		
-		# Motion Detection
-		# capture frames from the camera
-		for f in camera.capture_continuous(rawCapture, format="bgr"): #, use_video_port=True):
-			# grab the raw NumPy array representing the image and initialize
-			# the timestamp and occupied/unoccupied text
-			frame = f.array
-			#timestamp = datetime.datetime.now()
-			text = "No Motion"
-			
-			# resize the frame, convert it to grayscale, and blur it
-			frame = imutils.resize(frame, width=500)
-			gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-			gray = cv2.GaussianBlur(gray, (21, 21), 0)
-			
-			# if the average frame is None, initialize it
-			if avg is None:
-				print("[INFO] starting background model...")
-				avg = gray.copy().astype("float")
-				rawCapture.truncate(0)
-				continue
-				
-			# accumulate the weighted average between the current frame and
-			# previous frames, then compute the difference between the current
-			# frame and running average
-			cv2.accumulateWeighted(gray, avg, 0.5)
-			frameDelta = cv2.absdiff(gray, cv2.convertScaleAbs(avg))
-			
-			# threshold the delta image, dilate the thresholded image to fill
-			# in holes, then find contours on thresholded image
-			thresh = cv2.threshold(frameDelta, 5, 255,
-				cv2.THRESH_BINARY)[1]
-			thresh = cv2.dilate(thresh, None, iterations=2)
-			cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL,
-				cv2.CHAIN_APPROX_SIMPLE)
-			cnts = imutils.grab_contours(cnts)
-			
-			# loop over the contours
-			for c in cnts:
-				# if the contour is too small, ignore it
-				if cv2.contourArea(c) < 5000:
-					continue
-					
-				# compute the bounding box for the contour, draw it on the frame,
-				# and update the text
-				(x, y, w, h) = cv2.boundingRect(c)
-				cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-				text = "Motion!"
-				
-			# display the image
-			cv2.imshow('Motion Detection', frame)
+		if not args.headless:
+			# draw the bounding boxes on the frame and display it
+			annotated = draw_boxes(frame, boxes, targetBox)
+			cv2.imshow('Motion Detection', annotated)
 			key = cv2.waitKey(1) & 0xFF
-			# if the `r` key is pressed, refresh the average
+			# if the `q` key is pressed, refresh the average
 			if key == ord("q"):
-				avg = None
-			
-			# truncate rawCapture so we can use it again
-			# (avoids "Incorrect buffer length for resolution" errors)
-			rawCapture.truncate(0)
+				detector.reset()
+		if debugStream is not None and debugStream.wanted(now):
+			debugStream.publish(draw_boxes(frame, boxes, targetBox), now)
+		if cameraTimer is not None:
+			cameraTimer.lap("display")
 		
-			now = time.time()
-			dt  = now - startTime
-			
-			if (text == "Motion!"):
-				
-				# Motion detected to move eyes to center of motion
-				# and shrink the pupil
-				curX = ((x + (w / 2)) - 320) * 0.093 # scale x to +/-30
-				curY = ((y + (h / 2)) - 240) * 0.093 # scale y to +/-30
-				currentPupilScale = PUPIL_MIN
-				
-			else:
-
-				# Autonomous eye position
-				if isMoving == True:
-					if dt <= moveDuration:
-						scale        = (now - startTime) / moveDuration
-						# Ease in/out curve: 3*t^2-2*t^3
-						scale = 3.0 * scale * scale - 2.0 * scale * scale * scale
-						curX         = startX + (destX - startX) * scale
-						curY         = startY + (destY - startY) * scale
-					else:
-						startX       = destX
-						startY       = destY
-						curX         = destX
-						curY         = destY
-						holdDuration = random.uniform(0.15, 1.7)
-						startTime    = now
-						isMoving     = False
-				else:
-					if dt >= holdDuration:
-						destX        = random.uniform(-30.0, 30.0)
-						n            = math.sqrt(900.0 - destX * destX)
-						destY        = random.uniform(-n, n)
-						moveDuration = random.uniform(0.075, 0.175)
-						startTime    = now
-						isMoving     = True
-						
-				# Autonomous pupil size
-				# Use sin to vary the pupil diameter from 50% to PUPIL_MAX over 10 seconds
-				currentPupilScale = ((math.sin(2 * math.pi * (now % 10) / 10) / 4) + 0.5) * PUPIL_MAX
-
-			# Blinking
-			if AUTOBLINK and (now - timeOfLastBlink) >= timeToNextBlink:
-				timeOfLastBlink = now
-				duration        = random.uniform(0.06, 0.12)
-				if blinkState != 1:
-					blinkState     = 1 # ENBLINK
-					blinkStartTime = now
-					blinkDuration  = duration
-				if (text == "Motion!"):
-					timeToNextBlink = random.uniform(4.0, 6.0)
-				else:
-					timeToNextBlink = duration * 3 + random.uniform(0.0, 4.0)
-
-			if blinkState: # Eye currently winking/blinking?
-				# Check if blink time has elapsed...
-				if (now - blinkStartTime) >= blinkDuration:
-					# Increment blink state
-					blinkState += 1
-					if blinkState > 2:
-							blinkState = 0 # NOBLINK
-					else:
-							blinkDuration *= 2.0
-							blinkStartTime = now
-
-			if blinkState:
-				lidWeight = (now - blinkStartTime) / blinkDuration
-				if lidWeight > 1.0: lidWeight = 1.0
-				if blinkState == 2: lidWeight = 1.0 - lidWeight
-			else:
-				lidWeight = 0.0
+		if target is not None:
+			# Motion detected so point the eyes at the tracked target
+			(x, y, w, h) = targetBox
+			if args.print_target:
+				print("target", x + (w / 2), y + (h / 2))
+			eyeModel.set_target(gaze(x + (w / 2), y + (h / 2)), now)
+		else:
+			eyeModel.set_target(None, now)
 
-			shared = {"curX":curX, "curY":curY, "pupil":currentPupilScale, "lid":lidWeight, "blink":blinkState}
-			
-			events = sel.select(timeout=None)
-			for key, mask in events:
-				if key.data is None:
-					accept_wrapper(key.fileobj)
-				else:
-					service_connection(key, mask, shared)
+		if cameraTimer is not None:
+			cameraTimer.lap("gaze")
+			if now - profileTime >= args.profile_interval:
+				profileTime = now
+				reportProfile(now)
+			cameraTimer.next_frame()
 
+	# The frame source has run dry (e.g. a camera device that went away,
+	# or a video file that couldn't be rewound); going round again would
+	# just spin, so stop and let whatever started the server restart it
+	raise SystemExit("[ERROR] frame source stopped producing frames")
 
 except KeyboardInterrupt:
     print("caught keyboard interrupt, exiting")
     
 finally:
-	cv2.destroyAllWindows()
-	sel.close()
+	if not args.headless:
+		cv2.destroyAllWindows()
+	if debugStream is not None:
+		debugStream.close()
+	source.close()
+	publisher.stop()
+	if DISCOVERY:
+		discovery.stop()
+	if profileLog is not None:
+		profileLog.close()
@@ -0,0 +1,133 @@
+"""Autonomous eye behaviour (saccades, pupil size and blinking), as run by
+   the eye server between, and in response to, motion detection results."""
+
+import math
+import random
+
+
+class EyeModel(object):
+    """Eye position, pupil and blink state model. Call update() at the
+       rate the state is sent to the clients; motion detection results
+       are passed in separately with set_target(), at whatever rate the
+       camera runs, and override the autonomous eye movement while they
+       are fresh."""
+
+    def __init__(self, autoblink=True, pupil_min=0.0, pupil_max=1.0,
+                 target_timeout=1.0):
+        self.autoblink = autoblink   # If True, eye blinks autonomously
+        self.pupil_min = pupil_min   # Lower analog range for pupil
+        self.pupil_max = pupil_max   # Upper "
+        self.target_timeout = target_timeout # Motion target lifetime
+
+        self.start_x = random.uniform(-30.0, 30.0)
+        n = math.sqrt(900.0 - self.start_x * self.start_x)
+        self.start_y = random.uniform(-n, n)
+        self.dest_x = self.start_x
+        self.dest_y = self.start_y
+        self.cur_x = self.start_x
+        self.cur_y = self.start_y
+        self.move_duration = random.uniform(0.075, 0.175)
+        self.hold_duration = random.uniform(0.1, 1.1)
+        self.start_time = 0.0
+        self.is_moving = False
+        self.pupil = 0.5
+        self.lid_weight = 0.0
+
+        self.time_of_last_blink = 0.0
+        self.time_to_next_blink = 1.0
+        self.blink_state = 0
+        self.blink_duration = 0.1
+        self.blink_start_time = 0
+
+        self._target = (None, 0.0)
+
+    def set_target(self, target, now):
+        """Set the motion target as an (x, y) eye angle tuple, or None if
+           no motion was seen. Safe to call from another thread."""
+        self._target = (target, now)
+
+    def update(self, now):
+        """Advance the model to time 'now' and return the shared state dict
+           (curX, curY, pupil, lid, blink) that is sent to the clients."""
+        target, target_time = self._target
+        if target is not None and now - target_time > self.target_timeout:
+            target = None # Camera has stopped reporting; go autonomous
+        dt = now - self.start_time
+
+        if target is not None:
+            # Motion detected so move eyes to center of motion
+            # and shrink the pupil
+            self.cur_x, self.cur_y = target
+            self.pupil = self.pupil_min
+        else:
+            # Autonomous eye position
+            if self.is_moving:
+                if dt <= self.move_duration:
+                    scale = dt / self.move_duration
+                    # Ease in/out curve: 3*t^2-2*t^3
+                    scale = 3.0 * scale * scale - 2.0 * scale * scale * scale
+                    self.cur_x = (self.start_x +
+                                  (self.dest_x - self.start_x) * scale)
+                    self.cur_y = (self.start_y +
+                                  (self.dest_y - self.start_y) * scale)
+                else:
+                    self.start_x = self.dest_x
+                    self.start_y = self.dest_y
+                    self.cur_x = self.dest_x
+                    self.cur_y = self.dest_y
+                    self.hold_duration = random.uniform(0.15, 1.7)
+                    self.start_time = now
+                    self.is_moving = False
+            else:
+                if dt >= self.hold_duration:
+                    self.dest_x = random.uniform(-30.0, 30.0)
+                    n = math.sqrt(900.0 - self.dest_x * self.dest_x)
+                    self.dest_y = random.uniform(-n, n)
+                    self.move_duration = random.uniform(0.075, 0.175)
+                    self.start_time = now
+                    self.is_moving = True
+
+            # Autonomous pupil size
+            # Use sin to vary the pupil diameter from 50% to pupil_max
+            # over 10 seconds
+            self.pupil = ((math.sin(2 * math.pi * (now % 10) / 10) / 4) +
+                          0.5) * self.pupil_max
+
+        # Blinking
+        if (self.autoblink and
+                (now - self.time_of_last_blink) >= self.time_to_next_blink):
+            self.time_of_last_blink = now
+            duration = random.uniform(0.06, 0.12)
+            if self.blink_state != 1:
+                self.blink_state = 1 # ENBLINK
+                self.blink_start_time = now
+                self.blink_duration = duration
+            if target is not None:
+                self.time_to_next_blink = random.uniform(4.0, 6.0)
+            else:
+                self.time_to_next_blink = (duration * 3 +
+                                           random.uniform(0.0, 4.0))
+
+        if self.blink_state: # Eye currently winking/blinking?
+            # Check if blink time has elapsed...
+            if (now - self.blink_start_time) >= self.blink_duration:
+                # Increment blink state
+                self.blink_state += 1
+                if self.blink_state > 2:
+                    self.blink_state = 0 # NOBLINK
+                else:
+                    self.blink_duration *= 2.0
+                    self.blink_start_time = now
+
+        if self.blink_state:
+            self.lid_weight = ((now - self.blink_start_time) /
+                               self.blink_duration)
+            if self.lid_weight > 1.0:
+                self.lid_weight = 1.0
+            if self.blink_state == 2:
+                self.lid_weight = 1.0 - self.lid_weight
+        else:
+            self.lid_weight = 0.0
+
+        return {"curX": self.cur_x, "curY": self.cur_y, "pupil": self.pupil,
+                "lid": self.lid_weight, "blink": self.blink_state}
@@ -0,0 +1,335 @@
+"""Eye rendering for the eye clients. EyeAssets holds everything that is
+   the same for both eyes (shader, textures, eye outline points and the
+   iris and eyelid mesh caches), so it is only loaded once per process;
+   EyeGeometry works out the eye's shape each frame, and each EyeRenderer
+   holds the pi3d shapes for one eye. A process can drive one eye, or
+   both eyes on one display as an EyePair sharing one EyeGeometry."""
+
+import math
+import pi3d
+from gfxutil import (load_svg_points, mesh_init, points_bounds, re_axis,
+                     scale_points, update_vertices, zangle)
+from meshcache import IrisMeshTable, LidMeshCache
+
+SIDES = ("left", "right")
+
+# Paths read from the SVG file: (name, number of points, closed, reverse).
+# Points are cached in <svg file>.npz, so the SVG itself is only parsed
+# the first time (or after it has been edited).
+SVG_PATHS = (
+    ("pupilMin"       , 32, True , True ),
+    ("pupilMax"       , 32, True , True ),
+    ("iris"           , 32, True , True ),
+    ("scleraFront"    ,  0, False, False),
+    ("scleraBack"     ,  0, False, False),
+    ("upperLidClosed" , 33, False, True ),
+    ("upperLidOpen"   , 33, False, True ),
+    ("upperLidEdge"   , 33, False, False),
+    ("lowerLidClosed" , 33, False, False),
+    ("lowerLidOpen"   , 33, False, False),
+    ("lowerLidEdge"   , 33, False, False),
+)
+
+# What differs between the left and right eye: iris texture U offset,
+# sclera texture offset, whether the lower lid mesh is flipped, and the
+# direction the eye turns in by for convergence.
+_SIDE_SETTINGS = {
+    "left" : (0.5, 0.5, True , 1.0),
+    "right": (0.0, 0.0, False, -1.0),
+}
+
+
+def _regen_threshold(open_pts, closed_pts):
+    """Change in eyelid weight that moves the middle of the lid 1/2 pixel.
+       Instead of bounds (as for the pupil) the distance between the middle
+       points of the open and closed eyelid paths is evaluated."""
+    p1 = open_pts[len(open_pts) // 2]
+    p2 = closed_pts[len(closed_pts) // 2]
+    dx = p2[0] - p1[0]
+    dy = p2[1] - p1[1]
+    d = dx * dx + dy * dy
+    if d > 0:
+        return 0.5 / math.sqrt(d)
+    return 0.0
+
+
+class EyeAssets(object):
+    """Shader, textures, eye geometry scaled to eye_radius pixels and mesh
+       caches, shared by every eye in the process. The pi3d Display must
+       already have been created."""
+
+    def __init__(self, eye_radius, svg_file="graphics/eye.svg",
+                 iris_cache_size=None, lid_cache_size=512):
+        self.eye_radius = eye_radius
+        self.shader = pi3d.Shader("uv_light")
+
+        self.iris_map = pi3d.Texture("graphics/iris.jpg", mipmap=False,
+                                     filter=pi3d.GL_LINEAR)
+        self.sclera_map = pi3d.Texture("graphics/sclera.png", mipmap=False,
+                                       filter=pi3d.GL_LINEAR, blend=True)
+        self.lid_map = pi3d.Texture("graphics/lid.png", mipmap=False,
+                                    filter=pi3d.GL_LINEAR, blend=True)
+        # U/V map may be useful for debugging texture placement
+        #self.uv_map = pi3d.Texture("graphics/uv.png", mipmap=False,
+        #                           filter=pi3d.GL_LINEAR, blend=False,
+        #                           m_repeat=True)
+
+        # Transform point lists to eye dimensions
+        vb, pts = load_svg_points(svg_file, SVG_PATHS)
+        for name in pts:
+            scale_points(pts[name], vb, eye_radius)
+        self.points = pts
+
+        # Regenerating flexible object geometry (such as eyelids during
+        # blinks, or iris during pupil dilation) is CPU intensive. To
+        # reduce this load, meshes are only regenerated for size changes
+        # of roughly 1/2 pixel, since 2x2 area sampling is used.
+        iris_threshold = 0.0
+        a = points_bounds(pts["pupilMin"]) # Bounds of pupil at min size
+        b = points_bounds(pts["pupilMax"]) # " at max size
+        max_dist = max(abs(a[0] - b[0]), abs(a[1] - b[1]),
+                       abs(a[2] - b[2]), abs(a[3] - b[3]))
+        # max_dist is motion range in pixels as pupil scales between 0.0
+        # and 1.0. 1.0 / max_dist is one pixel's worth of scale range.
+        if max_dist > 0:
+            iris_threshold = 0.5 / max_dist
+        upper_threshold = _regen_threshold(pts["upperLidOpen"],
+                                           pts["upperLidClosed"])
+        lower_threshold = _regen_threshold(pts["lowerLidOpen"],
+                                           pts["lowerLidClosed"])
+
+        # Iris geometry only changes in 1/2 pixel steps, so the set of
+        # meshes is small enough to build once and look up each frame.
+        # Eyelid geometry is looked up by (previous, new) lid weight,
+        # quantized the same way, so repeated blinks reuse meshes.
+        self.iris_z = zangle(pts["iris"], eye_radius)[0] * 0.99
+        self.iris_meshes = IrisMeshTable(pts["pupilMin"], pts["pupilMax"],
+                                         pts["iris"], -self.iris_z,
+                                         iris_threshold, 4, True,
+                                         iris_cache_size)
+        self.upper_lid_meshes = LidMeshCache(pts["upperLidOpen"],
+                                             pts["upperLidClosed"],
+                                             pts["upperLidEdge"],
+                                             upper_threshold, 5, 0,
+                                             lid_cache_size)
+        self.lower_lid_meshes = LidMeshCache(pts["lowerLidOpen"],
+                                             pts["lowerLidClosed"],
+                                             pts["lowerLidEdge"],
+                                             lower_threshold, 5, 0,
+                                             lid_cache_size)
+
+        # 2D outline of the sclera, for lathing
+        angle1 = zangle(pts["scleraFront"], eye_radius)[1] # Front angle
+        angle2 = zangle(pts["scleraBack"], eye_radius)[1]  # Back angle
+        a_range = 180 - angle1 - angle2
+        self.sclera_path = []
+        for i in range(24):
+            ca, sa = pi3d.Utility.from_polar((90 - angle1) - a_range * i / 23)
+            self.sclera_path.append((ca * eye_radius, sa * eye_radius))
+
+
+class EyeGeometry(object):
+    """Per-frame eye shape: eyelid tracking, and which iris and eyelid
+       meshes are current. After update(), iris_mesh, upper_lid_mesh and
+       lower_lid_bins are None if that part hasn't changed since the last
+       frame. When one process renders both eyes they share one of these,
+       so the geometry is only worked out once per frame."""
+
+    def __init__(self, assets, tracking=True):
+        self.assets = assets
+        self.tracking = tracking
+        self.prev_iris_bin = -1 # Force regen on first frame
+        self.prev_upper_lid_bin = assets.upper_lid_meshes.quantize(0.5)
+        self.prev_lower_lid_bin = assets.lower_lid_meshes.quantize(0.5)
+        self.upper_regen = True
+        self.lower_regen = True
+        self.tracking_pos = 0.3
+        self.cur_x = 0.0
+        self.cur_y = 0.0
+        self.iris_mesh = None
+        self.upper_lid_mesh = None
+        self.lower_lid_bins = None
+
+    def update(self, shared):
+        """Advance to a shared state dict (curX, curY, pupil, lid, blink)."""
+        self.update_iris(shared)
+        self.update_lids(shared)
+
+    def update_iris(self, shared):
+        """The iris part of update()."""
+        assets = self.assets
+        # Regenerate iris geometry only if size changed by >= 1/2 pixel
+        self.iris_mesh = None
+        iris_bin = assets.iris_meshes.quantize(shared["pupil"])
+        if iris_bin != self.prev_iris_bin:
+            self.iris_mesh = assets.iris_meshes.mesh(iris_bin)
+            self.prev_iris_bin = iris_bin
+
+    def update_lids(self, shared):
+        """The eye position and eyelid part of update()."""
+        assets = self.assets
+        self.cur_x = shared["curX"]
+        self.cur_y = shared["curY"]
+        lid_weight = shared["lid"]
+
+        if self.tracking:
+            # 0 = fully up, 1 = fully down
+            n = 0.4 - self.cur_y / 60.0
+            n = min(max(n, 0.0), 1.0)
+            self.tracking_pos = (self.tracking_pos * 3.0 + n) * 0.25
+
+        upper_weight = (self.tracking_pos +
+                        (lid_weight * (1.0 - self.tracking_pos)))
+        lower_weight = ((1.0 - self.tracking_pos) +
+                        (lid_weight * self.tracking_pos))
+
+        # Eyelids are regenerated once more after they stop moving, so
+        # the mesh ends up spanning just the final weight
+        self.upper_lid_mesh = None
+        new_bin = assets.upper_lid_meshes.quantize(upper_weight)
+        if self.upper_regen or new_bin != self.prev_upper_lid_bin:
+            self.upper_lid_mesh = assets.upper_lid_meshes.mesh(
+                self.prev_upper_lid_bin, new_bin, False)
+            self.prev_upper_lid_bin = new_bin
+            self.upper_regen = True
+        else:
+            self.upper_regen = False
+
+        # The lower lid is flipped differently for each eye, so only the
+        # bins are kept here; see lower_lid_mesh()
+        self.lower_lid_bins = None
+        new_bin = assets.lower_lid_meshes.quantize(lower_weight)
+        if self.lower_regen or new_bin != self.prev_lower_lid_bin:
+            self.lower_lid_bins = (self.prev_lower_lid_bin, new_bin)
+            self.prev_lower_lid_bin = new_bin
+            self.lower_regen = True
+        else:
+            self.lower_regen = False
+
+    def lower_lid_mesh(self, flip):
+        """Return the current lower lid mesh, flipped or not. The second
+           flip asked for in a frame is mirrored from the first."""
+        prev_bin, new_bin = self.lower_lid_bins
+        return self.assets.lower_lid_meshes.mesh(prev_bin, new_bin, flip)
+
+
+class EyeRenderer(object):
+    """One eye, 'left' or 'right', drawn centered at x pixels from the
+       middle of the display. Call update() with the shared state dict
+       (curX, curY, pupil, lid, blink) then draw() once per frame. If
+       tracking is True the eyelids follow the pupil up and down.
+       If an EyeGeometry is passed in it is shared with another eye and
+       advanced by its owner (see EyePair); call apply() instead of
+       update() to pick up its changes."""
+
+    convergence = 2.0
+
+    def __init__(self, assets, side, x=0.0, tracking=True, geometry=None):
+        if side not in SIDES:
+            raise ValueError("side must be one of %s" % (SIDES,))
+        iris_u, sclera_u, self.lower_lid_flip, self.turn = (
+            _SIDE_SETTINGS[side])
+        self.assets = assets
+        self.side = side
+        if geometry is None:
+            geometry = EyeGeometry(assets, tracking)
+        self.geometry = geometry
+
+        # Meshes are set up with texture coordinates only; vertices are
+        # replaced from the mesh caches as the eye changes shape.
+        self.iris = mesh_init((32, 4), (iris_u, 0.5 / assets.iris_map.iy),
+                              True, False)
+        self.iris.set_textures([assets.iris_map])
+        self.iris.set_shader(assets.shader)
+        self.upper_lid = mesh_init((33, 5), (0, 0.5 / assets.lid_map.iy),
+                                   False, True)
+        self.upper_lid.set_textures([assets.lid_map])
+        self.upper_lid.set_shader(assets.shader)
+        self.lower_lid = mesh_init((33, 5), (0, 0.5 / assets.lid_map.iy),
+                                   False, True)
+        self.lower_lid.set_textures([assets.lid_map])
+        self.lower_lid.set_shader(assets.shader)
+
+        self.eye = pi3d.Lathe(path=assets.sclera_path, sides=64)
+        self.eye.set_textures([assets.sclera_map])
+        self.eye.set_shader(assets.shader)
+        re_axis(self.eye, sclera_u)
+
+        self.eye.positionX(x)
+        self.iris.positionX(x)
+        self.upper_lid.positionX(x)
+        self.upper_lid.positionZ(-assets.eye_radius - 42)
+        self.lower_lid.positionX(x)
+        self.lower_lid.positionZ(-assets.eye_radius - 42)
+
+    def update(self, shared, timer=None):
+        """Bring the eye's geometry up to date with a shared state dict.
+           If a perfutil.FrameTimer is given, the iris and eyelid work is
+           timed as its "iris" and "lid" stages."""
+        self.geometry.update_iris(shared)
+        self.apply_iris()
+        if timer is not None:
+            timer.lap("iris")
+        self.geometry.update_lids(shared)
+        self.apply_lids()
+        if timer is not None:
+            timer.lap("lid")
+
+    def apply(self):
+        """Copy any geometry changes into this eye's shapes."""
+        self.apply_iris()
+        self.apply_lids()
+
+    def apply_iris(self):
+        if self.geometry.iris_mesh is not None:
+            update_vertices(self.iris, self.geometry.iris_mesh)
+
+    def apply_lids(self):
+        geometry = self.geometry
+        if geometry.upper_lid_mesh is not None:
+            update_vertices(self.upper_lid, geometry.upper_lid_mesh)
+        if geometry.lower_lid_bins is not None:
+            update_vertices(self.lower_lid,
+                            geometry.lower_lid_mesh(self.lower_lid_flip))
+
+    def draw(self):
+        cur_y = self.geometry.cur_y
+        turn_y = self.geometry.cur_x + self.convergence * self.turn
+        self.iris.rotateToX(cur_y)
+        self.iris.rotateToY(turn_y)
+        self.iris.draw()
+        self.eye.rotateToX(cur_y)
+        self.eye.rotateToY(turn_y)
+        self.eye.draw()
+        self.upper_lid.draw()
+        self.lower_lid.draw()
+
+
+class EyePair(object):
+    """Both eyes on one display, x pixels either side of the middle (the
+       right eye is on the viewer's left). The eyes share one EyeGeometry,
+       so each iris and eyelid mesh is only looked up or built once per
+       frame, and the one lower lid that differs between the eyes is
+       mirrored from the other rather than interpolated again."""
+
+    def __init__(self, assets, x, tracking=True):
+        self.geometry = EyeGeometry(assets, tracking)
+        self.eyes = [EyeRenderer(assets, "right", -x, geometry=self.geometry),
+                     EyeRenderer(assets, "left", x, geometry=self.geometry)]
+
+    def update(self, shared, timer=None):
+        """As EyeRenderer.update(), for both eyes."""
+        self.geometry.update_iris(shared)
+        for eye in self.eyes:
+            eye.apply_iris()
+        if timer is not None:
+            timer.lap("iris")
+        self.geometry.update_lids(shared)
+        for eye in self.eyes:
+            eye.apply_lids()
+        if timer is not None:
+            timer.lap("lid")
+
+    def draw(self):
+        for eye in self.eyes:
+            eye.draw()
@@ -0,0 +1,200 @@
+"""Camera to eye angle calibration for the eye server.
+   A calibration is fitted from a few recorded pairs of camera position
+   (where something was seen in the image) and eye angle (where the eyes
+   had to look to point at it), either as a homography or as a 2nd order
+   polynomial, and saved as JSON. Camera positions are normalized to 0.0
+   to 1.0 across the image so one calibration serves any processing size;
+   at runtime a GazeMapper holds a lookup table for one processing size,
+   so mapping a point is just an array index.
+
+   Fit a calibration from a file of 'camera_x camera_y eye_x eye_y' lines
+   (camera positions in pixels at --size) with:
+      python3 gazecal.py pairs.txt [--size w h] [--model poly2] [-o file]"""
+
+import json
+import os
+import numpy as np
+
+MODELS = ("homography", "poly2")
+
+# Eye angles run from about -30 to +30. With no calibration file, map the
+# image linearly onto that range, which is what the original fixed scale of
+# 0.093 degrees per pixel on a 640x480 frame was meant to do.
+DEFAULT_SCALE = 0.093
+DEFAULT_HOMOGRAPHY = [[640 * DEFAULT_SCALE, 0.0, -320 * DEFAULT_SCALE],
+                      [0.0, 480 * DEFAULT_SCALE, -240 * DEFAULT_SCALE],
+                      [0.0, 0.0, 1.0]]
+
+# Pixel spacing of the grid GazeMapper.locate() searches
+LOCATE_STEP = 4
+
+
+def _poly_terms(u, v):
+    """Return (N, 6) 2nd order polynomial terms of normalized positions."""
+    return np.stack((np.ones_like(u), u, v, u * u, u * v, v * v), axis=-1)
+
+
+class GazeCalibration(object):
+    """Mapping from normalized camera positions (u, v in 0.0 to 1.0) to eye
+       angles. For the "homography" model coeffs is a 3x3 matrix, for the
+       "poly2" model it is 2 rows (x, y) of 6 coefficients for the terms
+       1, u, v, u*u, u*v, v*v."""
+
+    def __init__(self, model="homography", coeffs=None):
+        if model not in MODELS:
+            raise ValueError("unknown calibration model %r" % (model,))
+        if coeffs is None:
+            if model != "homography":
+                raise ValueError("%s model needs coefficients" % model)
+            coeffs = DEFAULT_HOMOGRAPHY
+        self.model = model
+        self.coeffs = np.asarray(coeffs, dtype=np.float64)
+        shape = (3, 3) if model == "homography" else (2, 6)
+        if self.coeffs.shape != shape:
+            raise ValueError("%s coefficients must be %dx%d" %
+                             ((model,) + shape))
+
+    def apply(self, u, v):
+        """Map arrays of normalized camera positions to (eye_x, eye_y)
+           arrays of angles."""
+        u = np.asarray(u, dtype=np.float64)
+        v = np.asarray(v, dtype=np.float64)
+        if self.model == "homography":
+            h = self.coeffs
+            w = h[2, 0] * u + h[2, 1] * v + h[2, 2]
+            return ((h[0, 0] * u + h[0, 1] * v + h[0, 2]) / w,
+                    (h[1, 0] * u + h[1, 1] * v + h[1, 2]) / w)
+        terms = _poly_terms(u, v)
+        return (terms.dot(self.coeffs[0]), terms.dot(self.coeffs[1]))
+
+    def residuals(self, cam, eye):
+        """Return per-pair distance, in eye angle units, between the fitted
+           and recorded eye angles."""
+        cam = np.asarray(cam, dtype=np.float64)
+        eye = np.asarray(eye, dtype=np.float64)
+        x, y = self.apply(cam[:, 0], cam[:, 1])
+        return np.hypot(x - eye[:, 0], y - eye[:, 1])
+
+    def to_dict(self):
+        return {"model": self.model, "coeffs": self.coeffs.tolist()}
+
+    def save(self, filename, pairs=None):
+        """Write calibration as JSON, along with the (normalized camera,
+           eye) pairs it was fitted from if given, for reference."""
+        data = self.to_dict()
+        if pairs is not None:
+            data["pairs"] = [[list(map(float, c)), list(map(float, e))]
+                             for c, e in pairs]
+        with open(filename, "w") as f:
+            json.dump(data, f, indent=2)
+
+
+def fit(cam, eye, model="homography"):
+    """Fit a GazeCalibration to (N, 2) normalized camera positions and
+       (N, 2) eye angles. A homography needs at least 4 pairs and the
+       polynomial at least 6; more pairs are fitted in the least squares
+       sense."""
+    cam = np.asarray(cam, dtype=np.float64)
+    eye = np.asarray(eye, dtype=np.float64)
+    if cam.shape != eye.shape or cam.ndim != 2 or cam.shape[1] != 2:
+        raise ValueError("camera and eye points must both be (N, 2)")
+    u, v = cam[:, 0], cam[:, 1]
+    x, y = eye[:, 0], eye[:, 1]
+    if model == "homography":
+        if len(cam) < 4:
+            raise ValueError("homography needs at least 4 point pairs")
+        # Direct linear transform: h is the null vector of a
+        zero = np.zeros_like(u)
+        one = np.ones_like(u)
+        a = np.concatenate((
+            np.stack((u, v, one, zero, zero, zero, -x * u, -x * v, -x), 1),
+            np.stack((zero, zero, zero, u, v, one, -y * u, -y * v, -y), 1)))
+        h = np.linalg.svd(a)[2][-1].reshape(3, 3)
+        return GazeCalibration(model, h / h[2, 2])
+    if model == "poly2":
+        if len(cam) < 6:
+            raise ValueError("poly2 needs at least 6 point pairs")
+        terms = _poly_terms(u, v)
+        coeffs = np.linalg.lstsq(terms, eye, rcond=None)[0].T
+        return GazeCalibration(model, coeffs)
+    raise ValueError("unknown calibration model %r" % (model,))
+
+
+def load_calibration(filename):
+    """Read a calibration saved by GazeCalibration.save(). If filename is
+       None or doesn't exist, return the default linear mapping."""
+    if filename is None or not os.path.exists(filename):
+        return GazeCalibration()
+    with open(filename) as f:
+        data = json.load(f)
+    return GazeCalibration(data["model"], data["coeffs"])
+
+
+class GazeMapper(object):
+    """Lookup table of eye angles for every pixel of one processing size.
+       Calling the mapper with a pixel position (typically the center of a
+       motion bounding box) returns an (eye_x, eye_y) tuple; locate() goes
+       the other way."""
+
+    def __init__(self, calibration, size):
+        width, height = size
+        self.size = size
+        # Sample at pixel centers
+        u = (np.arange(width, dtype=np.float64) + 0.5) / width
+        v = (np.arange(height, dtype=np.float64) + 0.5) / height
+        lut_x, lut_y = calibration.apply(*np.meshgrid(u, v))
+        self.lut = np.stack((lut_x, lut_y), axis=-1).astype(np.float32)
+        # Every LOCATE_STEP'th pixel, for the reverse lookup
+        self._coarse = self.lut[::LOCATE_STEP, ::LOCATE_STEP].reshape(-1, 2)
+        self._coarse_width = (width + LOCATE_STEP - 1) // LOCATE_STEP
+
+    def __call__(self, x, y):
+        width, height = self.size
+        col = min(max(int(x), 0), width - 1)
+        row = min(max(int(y), 0), height - 1)
+        eye_x, eye_y = self.lut[row, col].tolist()
+        return (eye_x, eye_y)
+
+    def locate(self, eye_x, eye_y):
+        """Return the (x, y) pixel position whose eye angles are nearest
+           (eye_x, eye_y), to within LOCATE_STEP pixels."""
+        dist = np.square(self._coarse - (eye_x, eye_y)).sum(axis=1)
+        row, col = divmod(int(dist.argmin()), self._coarse_width)
+        return (col * LOCATE_STEP + 0.5, row * LOCATE_STEP + 0.5)
+
+
+def read_pairs(filename, size):
+    """Read 'camera_x camera_y eye_x eye_y' lines (camera position in
+       pixels of an image of the given size; blank lines and # comments
+       ignored) and return (normalized camera, eye) (N, 2) arrays."""
+    rows = []
+    with open(filename) as f:
+        for line in f:
+            line = line.split("#", 1)[0].replace(",", " ").split()
+            if line:
+                rows.append([float(n) for n in line[:4]])
+    rows = np.array(rows, dtype=np.float64).reshape(-1, 4)
+    cam = rows[:, :2] / np.array(size, dtype=np.float64)
+    return cam, rows[:, 2:]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Fit a camera to eye angle calibration")
+    parser.add_argument("pairs", help="file of 'camera_x camera_y eye_x "
+                        "eye_y' lines, camera positions in pixels")
+    parser.add_argument("--size", type=int, nargs=2, default=(320, 240),
+                        metavar=("W", "H"),
+                        help="camera image size the pairs were recorded at")
+    parser.add_argument("--model", choices=MODELS, default="homography")
+    parser.add_argument("-o", "--output", default="gaze_calibration.json")
+    args = parser.parse_args()
+
+    cam, eye = read_pairs(args.pairs, args.size)
+    calibration = fit(cam, eye, args.model)
+    errors = calibration.residuals(cam, eye)
+    print("%s fit to %d pairs: mean error %.2f, max error %.2f" %
+          (args.model, len(cam), errors.mean(), errors.max()))
+    calibration.save(args.output, zip(cam.tolist(), eye.tolist()))
+    print("saved", args.output)
@@ -1,9 +1,14 @@
 """Utility functions used by the eyes code, related to 2D SGV paths and
    3D pi3d geometry."""
 
+import hashlib
+import json
 import math
+import os
+from xml.etree import ElementTree
+import numpy as np
 import pi3d
-from svg.path import parse_path
+from svg.path import Move, parse_path
 
 def get_view_box(root):
     """Get artboard bounds (to use Illustrator terminology)
@@ -33,6 +38,30 @@ def get_path(root, path_name):
     return None
 
 
+def index_svg(filename):
+    """Single pass over an SVG file, returning its view box (as for
+       get_view_box()) and a dict of path id -> parsed path, so looking up
+       several paths doesn't mean walking the whole tree for each one.
+       The file is streamed with iterparse and elements are discarded as
+       they're done with, so no full DOM is held in memory."""
+    view_box = None
+    paths = {}
+    for event, elem in ElementTree.iterparse(filename, events=("start",
+                                                                "end")):
+        tag = elem.tag.rsplit("}", 1)[-1].lower() # Drop any namespace
+        if event == "start":
+            if tag == "svg" and view_box is None and elem.get("viewBox"):
+                view_box = tuple(float(n) for n in
+                                 elem.get("viewBox").split()[0:4])
+        else:
+            if tag == "path":
+                path_id = elem.get("id")
+                if path_id and path_id not in paths:
+                    paths[path_id] = parse_path(elem.get("d"))
+            elem.clear()
+    return view_box, paths
+
+
 def path_to_points(path, num_points, closed, reverse):
     """Convert SVG path to a 2D point list. Provide path, number of points,
        and whether or not this is a closed path (loop). For closed loops,
@@ -56,21 +85,302 @@ def path_to_points(path, num_points, closed, reverse):
     return points
 
 
+def _segment_points(segment, t):
+    """Evaluate an svg.path segment at an array of parametric positions,
+       returning a complex array. Lines and Bezier curves are done in one
+       go with NumPy; anything else (arcs) falls back to segment.point()."""
+    if hasattr(segment, "control2"): # Cubic Bezier
+        t1 = 1.0 - t
+        return (t1 * t1 * t1 * segment.start +
+                3.0 * t1 * t1 * t * segment.control1 +
+                3.0 * t1 * t * t * segment.control2 +
+                t * t * t * segment.end)
+    if hasattr(segment, "control"): # Quadratic Bezier
+        t1 = 1.0 - t
+        return (t1 * t1 * segment.start + 2.0 * t1 * t * segment.control +
+                t * t * segment.end)
+    if hasattr(segment, "radius"): # Arc
+        return np.array([segment.point(pos) for pos in t.tolist()],
+                        dtype=complex)
+    return segment.start + (segment.end - segment.start) * t # Line, etc.
+
+
+# 16 point Gauss-Legendre quadrature on [0, 1], for Bezier arc lengths
+_GAUSS_NODES, _GAUSS_WEIGHTS = np.polynomial.legendre.leggauss(16)
+_GAUSS_NODES = (_GAUSS_NODES + 1.0) / 2.0
+_GAUSS_WEIGHTS = _GAUSS_WEIGHTS / 2.0
+
+
+def _segment_lengths(segments, tolerance):
+    """Arc lengths of a list of path segments. Lines are exact, and all
+       the Bezier curves are integrated together by Gauss-Legendre
+       quadrature of the speed |B'(t)| (quadratics as the equivalent
+       cubics), which for curves like the eye's is good to far better
+       than 'tolerance'. Anything else (arcs) uses segment.length()."""
+    lengths = np.empty(len(segments))
+    curves = []
+    controls = []
+    for index, segment in enumerate(segments):
+        if hasattr(segment, "control2"): # Cubic Bezier
+            curves.append(index)
+            controls.append((segment.start, segment.control1,
+                             segment.control2, segment.end))
+        elif hasattr(segment, "control"): # Quadratic Bezier
+            curves.append(index)
+            controls.append((segment.start,
+                             segment.start + (segment.control -
+                                              segment.start) * 2.0 / 3.0,
+                             segment.end + (segment.control -
+                                            segment.end) * 2.0 / 3.0,
+                             segment.end))
+        elif hasattr(segment, "radius"): # Arc
+            lengths[index] = segment.length(error=tolerance)
+        else: # Line, Close, Move
+            lengths[index] = abs(segment.end - segment.start)
+    if curves:
+        p0, p1, p2, p3 = np.array(controls, dtype=complex).T
+        t = _GAUSS_NODES
+        t1 = 1.0 - t
+        speed = np.abs(np.outer(p1 - p0, t1 * t1) +
+                       np.outer(p2 - p1, 2.0 * t1 * t) +
+                       np.outer(p3 - p2, t * t)) * 3.0
+        lengths[curves] = speed.dot(_GAUSS_WEIGHTS)
+    return lengths
+
+
+def path_to_points_array(path, num_points, closed, reverse,
+                         tolerance=1e-5):
+    """Batched version of path_to_points(), returning an (N, 2) float32
+       array. path.point() does a separate length search for every sample;
+       instead this measures each segment once and places all samples in
+       one go, with the same spacing as path_to_points() (by arc length
+       across segments, by curve parameter within each segment).
+       'tolerance' is the relative error allowed in the lengths of any
+       arcs (Bezier curves are measured by quadrature)."""
+    num_points = max(num_points, 2)
+    if closed:
+        div = float(num_points)
+    else:
+        div = float(num_points - 1)
+    pos = np.arange(num_points) / div
+    if reverse:
+        pos = 1.0 - pos
+
+    segments = list(path)
+    lengths = _segment_lengths(segments, tolerance)
+    total = lengths.sum()
+    seg_index = np.zeros(num_points, dtype=int)
+    seg_pos = pos.copy()
+    if total > 0:
+        fractions = np.cumsum(lengths) / total
+        seg_index = np.minimum(np.searchsorted(fractions, pos, side="right"),
+                               len(segments) - 1)
+        starts = np.concatenate(([0.0], fractions[:-1]))[seg_index]
+        seg_pos = (pos - starts) / (fractions[seg_index] - starts)
+    # Same end point shortcuts as svg.path's Path.point()
+    seg_index[pos == 1.0] = len(segments) - 1
+    seg_pos[pos == 1.0] = 1.0
+    seg_index[pos == 0.0] = 1 if (len(segments) > 1 and
+                                  isinstance(segments[0], Move)) else 0
+    seg_pos[pos == 0.0] = 0.0
+
+    points = np.empty(num_points, dtype=complex)
+    for index in np.unique(seg_index).tolist():
+        mask = seg_index == index
+        points[mask] = _segment_points(segments[index], seg_pos[mask])
+    if closed:
+        points = np.append(points, points[0])
+    return np.stack((points.real, points.imag), axis=1).astype(np.float32)
+
+
 def get_points(root, path_name, num_points, closed, reverse):
-    """Combo wrapper for path_to_points(get_path(...))."""
-    return path_to_points(get_path(root, path_name),
-                          num_points, closed, reverse)
+    """Combo wrapper for path_to_points(get_path(...)), using the batched
+       path_to_points_array() sampler. 'root' may be an SVG DOM tree or a
+       path index dict from index_svg()."""
+    if isinstance(root, dict):
+        path = root.get(path_name)
+    else:
+        path = get_path(root, path_name)
+    return _to_tuples(path_to_points_array(path, num_points, closed, reverse))
+
+
+def _file_sha1(filename):
+    with open(filename, "rb") as in_file:
+        return hashlib.sha1(in_file.read()).hexdigest()
+
+
+def _save_svg_cache(cache_name, mtime, sha1, spec_key, view_box, points):
+    """Write the load_svg_points() cache file, replacing any old one."""
+    arrays = {"path_" + name: pts for name, pts in points.items()}
+    tmp_name = cache_name + ".tmp"
+    try:
+        with open(tmp_name, "wb") as cache_file:
+            np.savez(cache_file, _mtime=np.float64(mtime),
+                     _sha1=np.str_(sha1), _specs=np.str_(spec_key),
+                     _view_box=np.array(view_box, dtype=np.float64),
+                     **arrays)
+        os.replace(tmp_name, cache_name)
+    except OSError:
+        pass # Read-only install; just go without a cache
+
+
+def load_svg_points(filename, specs, cache=True):
+    """Load the view box and a set of named paths from an SVG file,
+       converted to point lists. 'specs' is a sequence of (path name,
+       number of points, closed, reverse) tuples, as passed to get_points().
+       Returns (view_box, dict of path name -> (N, 2) float32 array).
+       Parsing the SVG and sampling its curves is slow on a Pi Zero, so
+       the results are stored in a binary cache next to the SVG
+       (filename + ".npz"). The cache is reused if the SVG's mtime is
+       unchanged, or failing that if its SHA-1 hash still matches (e.g.
+       after a fresh unzip, in which case the cache is rewritten with the
+       new mtime), and if the same specs were requested."""
+    cache_name = filename + ".npz"
+    mtime = os.stat(filename).st_mtime
+    spec_key = json.dumps([list(spec) for spec in specs])
+    sha1 = None
+
+    if cache:
+        try:
+            with np.load(cache_name, allow_pickle=False) as cached:
+                if str(cached["_specs"]) == spec_key:
+                    valid = float(cached["_mtime"]) == mtime
+                    if not valid:
+                        sha1 = _file_sha1(filename)
+                        valid = str(cached["_sha1"]) == sha1
+                    if valid:
+                        view_box = tuple(cached["_view_box"].tolist())
+                        points = {spec[0]: cached["path_" + spec[0]]
+                                  for spec in specs}
+                        if sha1 is not None:
+                            # Only the mtime has changed; record it so
+                            # the SVG isn't hashed again next time
+                            _save_svg_cache(cache_name, mtime, sha1,
+                                            spec_key, view_box, points)
+                        return view_box, points
+        except (OSError, KeyError, ValueError):
+            pass # Missing or unreadable cache; rebuild it
+
+    view_box, paths = index_svg(filename)
+    points = {}
+    for path_name, num_points, closed, reverse in specs:
+        points[path_name] = path_to_points_array(paths.get(path_name),
+                                                 num_points, closed, reverse)
+
+    if cache:
+        if sha1 is None:
+            sha1 = _file_sha1(filename)
+        _save_svg_cache(cache_name, mtime, sha1, spec_key, view_box, points)
+
+    return view_box, points
+
+
+def as_points(points):
+    """Return a 2D point list as an (N, 2) float32 NumPy array. Arrays
+       that are already in that form are passed through without a copy."""
+    return np.asarray(points, dtype=np.float32).reshape(-1, 2)
+
+
+def _to_tuples(points):
+    """Convert an (N, 2) or (N, 3) array back to a list of tuples, for
+       callers using the original point list API."""
+    return list(map(tuple, points.tolist()))
+
+
+def scale_points_array(points, view_box, radius):
+    """NumPy version of scale_points(). Returns a new (N, 2) float32
+       array rather than modifying the point list in place."""
+    points = as_points(points)
+    origin = np.array(view_box[0:2], dtype=np.float32)
+    size = np.array(view_box[2:4], dtype=np.float32)
+    scale = np.array((radius * 2.0, radius * -2.0), dtype=np.float32)
+    return ((points - origin) / size - np.float32(0.5)) * scale
+
+
+def points_interp_array(points1, points2, weight2, out=None):
+    """NumPy version of points_interp(). Returns an (N, 2) float32 array,
+       or None if either point list is empty. If 'out' is given (an array
+       of the right shape) the result is written there instead of being
+       allocated."""
+    points1 = as_points(points1)
+    points2 = as_points(points2)
+    num_points = min(len(points1), len(points2))
+    if num_points < 1:
+        return None
+    weight2 = min(max(0.0, weight2), 1.0)
+    weight1 = 1.0 - weight2
+    if out is None:
+        out = np.empty((num_points, 2), dtype=np.float32)
+    np.multiply(points1[:num_points], np.float32(weight1), out=out)
+    out += points2[:num_points] * np.float32(weight2)
+    return out
+
+
+def points_bounds_array(points):
+    """NumPy version of points_bounds(), same 4-tuple result."""
+    points = as_points(points)
+    min_x, min_y = points.min(axis=0).tolist()
+    max_x, max_y = points.max(axis=0).tolist()
+    return (min_x, min_y, max_x, max_y)
+
+
+def points_mesh_array(points, steps, z_coord, flip=False):
+    """NumPy version of points_mesh(). Returns an (N, 3) float32 vertex
+       array in the same order as points_mesh() would, or None if the
+       point lists are empty. All V steps are interpolated at once."""
+    steps = max(steps, 2)
+    points1 = as_points(points[1])
+    points2 = as_points(points[2])
+    num_points = min(len(points1), len(points2))
+    if num_points < 1:
+        return None
+
+    weight2 = np.linspace(0.0, 1.0, steps, dtype=np.float32)[:, None, None]
+    rows = (points1[None, :num_points] * (np.float32(1.0) - weight2) +
+            points2[None, :num_points] * weight2)
+    rows = rows.reshape(-1, 2)
+    edge = points[0]
+    if edge is not None and len(edge) > 0:
+        rows = np.concatenate((as_points(edge), rows))
+        row_lengths = [len(edge)] + [num_points] * steps
+    else:
+        row_lengths = [num_points] * steps
+
+    verts = np.empty((len(rows), 3), dtype=np.float32)
+    if flip is True:
+        # Reverse each row and mirror on X
+        start = 0
+        for length in row_lengths:
+            end = start + length
+            verts[start:end, 0] = -rows[start:end, 0][::-1]
+            verts[start:end, 1] = rows[start:end, 1][::-1]
+            start = end
+    else:
+        verts[:, 0:2] = rows
+    verts[:, 2] = z_coord
+    return verts
+
+
+def mirror_mesh_array(verts, row_length):
+    """Mirror an (N, 3) vertex array from points_mesh_array() on X,
+       reversing each row of row_length vertices, which gives exactly the
+       array the opposite 'flip' setting would have. Much cheaper than
+       interpolating the mesh again. Rows must all be the same length."""
+    rows = verts.reshape(-1, row_length, 3)[:, ::-1]
+    mirrored = rows.reshape(-1, 3) # Copies, since rows is reversed
+    mirrored[:, 0] *= -1.0
+    return mirrored
 
 
 def scale_points(points, view_box, radius):
     """Scale a given 2D point list by normalizing to a given view box
        (returned by get_view_box()) then expanding to a given size
-       centered on (0,0)."""
-    for point_num, _ in enumerate(points): # Index of each point in path
-        points[point_num] = (((points[point_num][0] - view_box[0]) /
-                              view_box[2] - 0.5) * radius *  2.0,
-                             ((points[point_num][1] - view_box[1]) /
-                              view_box[3] - 0.5) * radius * -2.0)
+       centered on (0,0). The list (or array) is modified in place."""
+    scaled = scale_points_array(points, view_box, radius)
+    if isinstance(points, np.ndarray):
+        points[:] = scaled
+    else:
+        points[:] = _to_tuples(scaled)
 
 
 def points_interp(points1, points2, weight2):
@@ -78,30 +388,16 @@ def points_interp(points1, points2, weight2):
        Specify weighting (0.0 to 1.0) of second list. Lists should have
        same number of points; if not, lesser point count is used and the
        output may be weird."""
-    num_points = min(len(points1), len(points2))
-    if num_points < 1:
+    points = points_interp_array(points1, points2, weight2)
+    if points is None:
         return None
-    weight2 = min(max(0.0, weight2), 1.0)
-    weight1 = 1.0 - weight2
-    points = []
-    for point_num in range(num_points):
-        points.append(
-            (points1[point_num][0] * weight1 + points2[point_num][0] * weight2,
-             points1[point_num][1] * weight1 + points2[point_num][1] * weight2))
-    return points
+    return _to_tuples(points)
 
 
 def points_bounds(points):
     """Return bounding rect of 2D point list (as 4-tuple of min X, min Y,
        max X, max Y)."""
-    min_x, min_y, max_x, max_y = (points[0][0], points[0][1],
-                                  points[0][0], points[0][1])
-    for point in points[1:]:
-        min_x = min(min_x, point[0])
-        min_y = min(min_y, point[1])
-        max_x = max(max_x, point[0])
-        max_y = max(max_y, point[1])
-    return (min_x, min_y, max_x, max_y)
+    return points_bounds_array(points)
 
 
 def re_axis(shape, texture_offset):
@@ -128,6 +424,24 @@ def re_axis(shape, texture_offset):
 
 
 
+def update_vertices(shape, verts):
+    """Write new vertex positions (an (N, 3) array, e.g. from
+       points_mesh_array()) straight into a shape's existing vertex buffer
+       and re-upload it, instead of Shape.re_init() with a new point list.
+       Normals and texture coordinates never change after mesh_init() so
+       they are left alone. Like re_axis(), this works on pi3d's
+       interleaved array_buffer directly."""
+    buf = shape.buf[0]
+    num_verts = len(verts)
+    positions = buf.array_buffer[:num_verts, 0:3]
+    positions[:] = verts
+    # pi3d's Buffer.re_init() needs at least one array and re-sends the
+    # interleaved buffer in one go; handing it the positions we just
+    # wrote means there is nothing left for it to convert or allocate.
+    buf.re_init(pts=positions)
+
+
+
 # Instead of making these so general-purpose, I might intentionally
 # rig them to specifically handle the iris (closed shape) and eyelid
 # (open shape) cases. Esp. since the iris is a weird case that'll need
@@ -184,35 +498,10 @@ def mesh_init(uv_steps, uv_offset, closed, lid):
 def points_mesh(points, steps, z_coord, flip=False):
     """Generate mesh between two point lists. U axis steps are determined
        by number of points, V axis determined by 'steps'"""
-    steps = max(steps, 2)
-    num_points = min(len(points[1]), len(points[2]))
-    if num_points < 1:
+    verts = points_mesh_array(points, steps, z_coord, flip)
+    if verts is None:
         return None
-
-    verts = []
-
-    if flip is True:
-        if points[0]:
-            for point in reversed(points[0]):
-                verts.append((-point[0], point[1], z_coord))
-
-        div = float(steps - 1)
-        for y_index in range(steps):
-            point_list = points_interp(points[1], points[2], y_index / div)
-            for point in reversed(point_list):
-                verts.append((-point[0], point[1], z_coord))
-    else:
-        if points[0]:
-            for point in points[0]:
-                verts.append((point[0], point[1], z_coord))
-
-        div = float(steps - 1)
-        for y_index in range(steps):
-            point_list = points_interp(points[1], points[2], y_index / div)
-            for point in point_list:
-                verts.append((point[0], point[1], z_coord))
-
-    return verts
+    return _to_tuples(verts)
 
 
 def zangle(points, eye_radius):
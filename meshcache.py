@@ -0,0 +1,159 @@
+"""Precomputed / cached eyelid and iris geometry for the eye clients.
+   Regenerating these meshes is the most CPU-hungry part of each frame,
+   but since regeneration only happens in ~1/2 pixel increments the set
+   of distinct meshes is small, and can be looked up rather than rebuilt."""
+
+import math
+from collections import OrderedDict
+import numpy as np
+from gfxutil import as_points, mirror_mesh_array, points_mesh_array
+
+
+class LRUCache(object):
+    """Small bounded least-recently-used cache with hit/miss counters.
+       If max_size is None the cache is unbounded."""
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, build):
+        """Return cached value for key, calling build(key) on a miss."""
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            value = build(key)
+            self._items[key] = value
+            if self.max_size is not None and len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+            return value
+        self.hits += 1
+        self._items.move_to_end(key)
+        return value
+
+    def peek(self, key):
+        """Return cached value for key, or None, without counting a hit or
+           miss or changing its place in the LRU order."""
+        return self._items.get(key)
+
+    def stats(self):
+        """Return (hits, misses, current size) tuple."""
+        return (self.hits, self.misses, len(self._items))
+
+
+def _quantizer(threshold):
+    """Return (step, number of bins) for quantizing a 0.0 to 1.0 weight
+       in steps of 'threshold'. A zero threshold (geometry that doesn't
+       change shape) collapses to a single bin."""
+    if threshold > 0:
+        return (threshold, int(math.ceil(1.0 / threshold)) + 1)
+    return (1.0, 1)
+
+
+def _quantize(weight, step, num_bins):
+    weight = min(max(0.0, weight), 1.0)
+    return min(int(weight / step + 0.5), num_bins - 1)
+
+
+class IrisMeshTable(object):
+    """Iris vertex arrays for every pupil scale, quantized in steps of
+       'threshold' (the same 1/2 pixel irisRegenThreshold the clients use
+       to decide when to regenerate). With max_size=None the whole table
+       is built up front; otherwise meshes are built on demand and kept in
+       an LRU cache of that many entries."""
+
+    def __init__(self, pupil_min, pupil_max, iris, z_coord, threshold,
+                 steps=4, flip=True, max_size=None):
+        self.pupil_min = as_points(pupil_min)
+        self.pupil_max = as_points(pupil_max)
+        self.iris = as_points(iris)
+        self.z_coord = z_coord
+        self.steps = steps
+        self.flip = flip
+        self.step, self.num_bins = _quantizer(threshold)
+        if max_size is None:
+            self._table = [self._build(b) for b in range(self.num_bins)]
+            self._cache = None
+        else:
+            self._table = None
+            self._cache = LRUCache(max_size)
+
+    def quantize(self, scale):
+        """Return bin number for a given pupil scale (0.0 to 1.0)."""
+        return _quantize(scale, self.step, self.num_bins)
+
+    def _build(self, bin_num):
+        weight2 = min(bin_num * self.step, 1.0)
+        pupil = (self.pupil_min * np.float32(1.0 - weight2) +
+                 self.pupil_max * np.float32(weight2))
+        return points_mesh_array((None, pupil, self.iris), self.steps,
+                                 self.z_coord, self.flip)
+
+    def mesh(self, bin_num):
+        """Return (N, 3) vertex array for a bin returned by quantize()."""
+        if self._table is not None:
+            return self._table[bin_num]
+        return self._cache.get(bin_num, self._build)
+
+
+class LidMeshCache(object):
+    """Eyelid vertex arrays keyed on quantized (previous weight, new
+       weight, flip), with weights quantized in steps of 'threshold' (the
+       clients' upper/lowerLidRegenThreshold). An eyelid mesh only spans
+       the range between the two weights, so the key is order-independent.
+       There are far too many weight pairs to precompute, so meshes are
+       kept in an LRU cache of max_size entries; hit/miss counts are
+       available from stats(). A flipped mesh is the unflipped one
+       mirrored, so when the other flip of a pair is already cached (both
+       eyes rendered by one process) it is mirrored instead of rebuilt."""
+
+    def __init__(self, open_pts, closed_pts, edge_pts, threshold,
+                 steps=5, z_coord=0, max_size=512):
+        self.open_pts = as_points(open_pts)
+        self.closed_pts = as_points(closed_pts)
+        self.edge_pts = as_points(edge_pts)
+        self.steps = steps
+        self.z_coord = z_coord
+        self.step, self.num_bins = _quantizer(threshold)
+        self._cache = LRUCache(max_size)
+        # Mirroring needs every mesh row (edge included) the same length
+        num_points = min(len(self.open_pts), len(self.closed_pts))
+        if len(self.edge_pts) in (0, num_points) and num_points > 0:
+            self._row_length = num_points
+        else:
+            self._row_length = None
+
+    def quantize(self, weight):
+        """Return bin number for a given lid weight (0.0 to 1.0)."""
+        return _quantize(weight, self.step, self.num_bins)
+
+    def _lid_points(self, bin_num):
+        weight2 = min(bin_num * self.step, 1.0)
+        return (self.open_pts * np.float32(1.0 - weight2) +
+                self.closed_pts * np.float32(weight2))
+
+    def _build(self, key):
+        bin1, bin2, flip = key
+        if self._row_length is not None:
+            other = self._cache.peek((bin1, bin2, not flip))
+            if other is not None:
+                return mirror_mesh_array(other, self._row_length)
+        return points_mesh_array((self.edge_pts, self._lid_points(bin1),
+                                  self._lid_points(bin2)),
+                                 self.steps, self.z_coord, flip)
+
+    def mesh(self, prev_bin, new_bin, flip):
+        """Return (N, 3) vertex array for the eyelid spanning two bins
+           returned by quantize()."""
+        key = (min(prev_bin, new_bin), max(prev_bin, new_bin), flip)
+        return self._cache.get(key, self._build)
+
+    def stats(self):
+        """Return (hits, misses, current size) tuple."""
+        return self._cache.stats()
@@ -0,0 +1,741 @@
+"""Networking helpers shared by the eye server and clients: the binary
+   message used to send the eye state over the wire, the server side
+   publisher that sends it (over TCP and/or UDP multicast), finding the
+   server on the network, and the client side connection management,
+   receiving and smoothing of the state."""
+
+from collections import deque
+import errno
+import random
+import select
+import selectors
+import socket
+import struct
+import threading
+import time
+import types
+try:
+    import fcntl
+    import termios
+except ImportError: # Not on Windows
+    fcntl = None
+from perfutil import RollingStats
+
+# Eye state message: magic, protocol version, blink state, sequence
+# number, server timestamp, then curX, curY, pupil and lid as floats.
+# Fixed size, network byte order.
+STATE_MAGIC = b"EY"
+STATE_VERSION = 1
+STATE_FORMAT = struct.Struct("!2sBBIdffff")
+STATE_SIZE = STATE_FORMAT.size
+
+# Default group for UDP multicast mode (administratively scoped range)
+MULTICAST_GROUP = "239.255.42.99"
+
+# Server discovery: clients send DISCOVERY_QUERY to DISCOVERY_PORT (by
+# broadcast and multicast), the server replies with DISCOVERY_REPLY
+# followed by the IPv4 address and TCP port it's listening on.
+DISCOVERY_PORT = 65434
+DISCOVERY_QUERY = b"PIEYES?"
+DISCOVERY_REPLY = b"PIEYES!"
+DISCOVERY_ADDRESS = struct.Struct("!4sH")
+
+
+def pack_state(shared, seq, timestamp):
+    """Pack the shared eye state dict (curX, curY, pupil, lid, blink)
+       along with a sequence number and timestamp into a message."""
+    return STATE_FORMAT.pack(STATE_MAGIC, STATE_VERSION, shared["blink"],
+                             seq & 0xFFFFFFFF, timestamp, shared["curX"],
+                             shared["curY"], shared["pupil"], shared["lid"])
+
+
+def unpack_state(data, offset=0):
+    """Unpack one message at 'offset' in data, returning the eye state as
+       a dict (with "seq" and "time" added), or None if the message isn't
+       one of ours or is a different protocol version."""
+    (magic, version, blink, seq, timestamp,
+     cur_x, cur_y, pupil, lid) = STATE_FORMAT.unpack_from(data, offset)
+    if magic != STATE_MAGIC or version != STATE_VERSION:
+        return None
+    return {"curX": cur_x, "curY": cur_y, "pupil": pupil, "lid": lid,
+            "blink": blink, "seq": seq, "time": timestamp}
+
+
+class StateDecoder(object):
+    """Reassembles eye state messages from a TCP byte stream. TCP may
+       split a message across reads or join several into one, so bytes
+       are buffered until a whole message is available; if the stream
+       gets out of step, bytes are skipped until the next valid header."""
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        """Add received bytes, returning a list of any complete states."""
+        self._buf += data
+        states = []
+        start = 0
+        while True:
+            start = self._buf.find(STATE_MAGIC, start)
+            if start < 0:
+                # Keep a trailing partial magic byte for the next read
+                start = max(len(self._buf) - 1, 0)
+                if self._buf[start:] != STATE_MAGIC[:1]:
+                    start = len(self._buf)
+                break
+            if len(self._buf) - start < STATE_SIZE:
+                break
+            state = unpack_state(self._buf, start)
+            if state is None:
+                start += 1 # Not a real header; resync
+            else:
+                states.append(state)
+                start += STATE_SIZE
+        del self._buf[:start]
+        return states
+
+
+def seq_newer(seq, last):
+    """True if 32-bit sequence number seq comes after last, allowing for
+       wraparound."""
+    return 0 < ((seq - last) & 0xFFFFFFFF) < 0x80000000
+
+
+class DatagramDecoder(object):
+    """Decodes eye state messages arriving one per UDP datagram. Unlike
+       TCP, datagrams can be lost, duplicated or reordered, so anything
+       not newer than the last state accepted is dropped. A jump
+       backwards in sequence number is taken as the server having
+       restarted if the state's timestamp is newer than the last one
+       accepted (a late packet from the same run can't be), or if it's a
+       jump of more than restart_window packets."""
+
+    def __init__(self, restart_window=1000):
+        self.restart_window = restart_window
+        self.last_seq = None
+        self.last_time = None
+        self.dropped = 0
+
+    def feed(self, data):
+        """Decode one datagram, returning a list of zero or one states."""
+        if len(data) != STATE_SIZE:
+            return []
+        state = unpack_state(data)
+        if state is None:
+            return []
+        if self.last_seq is not None and not seq_newer(state["seq"],
+                                                       self.last_seq):
+            if (state["time"] <= self.last_time and
+                    (self.last_seq - state["seq"]) & 0xFFFFFFFF <=
+                    self.restart_window):
+                self.dropped += 1 # Stale or out of order
+                return []
+        self.last_seq = state["seq"]
+        self.last_time = state["time"]
+        return [state]
+
+
+class StateBuffer(object):
+    """Client side jitter buffer. Eye states are stored with their server
+       timestamps and rendered slightly in the past, interpolating between
+       the two states either side of the render time (as networked games
+       do for other players), so the eye moves smoothly between updates
+       rather than jumping when each one arrives. If updates stop, the
+       last motion is extrapolated for up to max_extrapolate seconds, then
+       held. The render delay is 'delay' seconds, or if that's None, 1.5x
+       the average interval between updates (so it adapts to the server's
+       send rate).
+       Receive and sample times should come from time.monotonic(), so the
+       client's clock being set (e.g. by NTP on a Pi with no real time
+       clock) doesn't throw the render time out. If the offset between
+       the clocks still jumps, so that states arrive more than resync
+       seconds behind the render time, it is measured again from scratch.
+       The buffer also starts again if the server's timestamps jump by
+       resync seconds or more either way (a clock step, or a gap in the
+       updates such as a reconnect).
+       push() and sample() may be called from different threads without
+       locking: after each push() the writer publishes an immutable
+       snapshot with a single reference assignment (atomic in Python),
+       and sample() only ever reads the latest snapshot."""
+
+    def __init__(self, delay=None, max_extrapolate=0.1, size=64,
+                 resync=1.0):
+        self.delay = delay
+        self.max_extrapolate = max_extrapolate
+        self.resync = resync
+        self.states = deque(maxlen=size)
+        self.offset = None    # Estimate of client clock - server clock
+        self.interval = None  # Smoothed interval between updates
+        self._snapshot = ((), 0.0, 0.0) # (states, offset, render delay)
+
+    def push(self, state, recv_time):
+        """Add a state received at (client monotonic clock) time
+           recv_time."""
+        if self.states:
+            gap = state["time"] - self.states[-1]["time"]
+            if -self.resync < gap <= 0.0:
+                return # Out of order or duplicate
+            if abs(gap) >= self.resync:
+                # Server clock jumped, or updates stopped for a while (e.g.
+                # a reconnect); start again rather than gliding through
+                # the gap or letting it skew the update interval
+                self.states.clear()
+                self.offset = None
+            else:
+                if self.interval is None:
+                    self.interval = gap
+                else:
+                    self.interval += (gap - self.interval) * 0.1
+        # Network delay only ever adds to the apparent offset, so track the
+        # lowest seen, letting it creep up slowly in case the clocks drift
+        offset = recv_time - state["time"]
+        if (self.offset is None or offset < self.offset or
+                offset - self.offset > self.resync):
+            self.offset = offset
+        else:
+            self.offset += (offset - self.offset) * 0.001
+        self.states.append(state)
+        self._snapshot = (tuple(self.states), self.offset,
+                          self.render_delay())
+
+    def render_delay(self):
+        if self.delay is not None:
+            return self.delay
+        if self.interval is None:
+            return 0.0
+        return self.interval * 1.5
+
+    def sample(self, now):
+        """Return the interpolated state dict for client monotonic clock
+           time now, or None if nothing has been received yet."""
+        states, offset, delay = self._snapshot
+        if not states:
+            return None
+        render_time = now - offset - delay
+        newest = states[-1]
+        if render_time >= newest["time"]:
+            if len(states) < 2:
+                return newest
+            prev = states[-2]
+            ahead = min(render_time - newest["time"], self.max_extrapolate)
+            weight = 1.0 + ahead / (newest["time"] - prev["time"])
+            state = _lerp_state(prev, newest, weight)
+            state["lid"] = min(max(0.0, state["lid"]), 1.0)
+            state["pupil"] = min(max(0.0, state["pupil"]), 1.0)
+            return state
+        if render_time <= states[0]["time"]:
+            return states[0]
+        for index in range(len(states) - 2, -1, -1):
+            prev = states[index]
+            if prev["time"] <= render_time:
+                after = states[index + 1]
+                return _lerp_state(prev, after,
+                                   (render_time - prev["time"]) /
+                                   (after["time"] - prev["time"]))
+        return states[0]
+
+
+def _lerp_state(state1, state2, weight2):
+    weight1 = 1.0 - weight2
+    state = dict(state1)
+    for name in ("curX", "curY", "pupil", "lid"):
+        state[name] = state1[name] * weight1 + state2[name] * weight2
+    return state
+
+
+def _is_multicast(addr):
+    return 224 <= int(addr.split(".")[0]) <= 239
+
+
+def open_multicast_sender(group, ttl=1):
+    """Return a UDP socket for sending to a multicast group, or to a
+       broadcast address. Loopback is enabled so clients on the same
+       machine also receive."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                         socket.IPPROTO_UDP)
+    if _is_multicast(group):
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    sock.setblocking(False)
+    return sock
+
+
+def open_multicast_receiver(group, port, interface="0.0.0.0"):
+    """Return a non-blocking UDP socket bound to port and joined to the
+       multicast group (if it is one; broadcasts need no joining).
+       Several clients on one machine can share the port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                         socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("", port))
+    if _is_multicast(group):
+        mreq = struct.pack("4s4s", socket.inet_aton(group),
+                           socket.inet_aton(interface))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    sock.setblocking(False)
+    return sock
+
+
+def _unsent_bytes(sock):
+    """Bytes queued in the kernel on a TCP socket that the other end
+       hasn't acknowledged yet, or None where that can't be found out."""
+    if fcntl is None or not hasattr(termios, "TIOCOUTQ"):
+        return None
+    try:
+        count = fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, b"\0\0\0\0")
+    except (OSError, ValueError): # ValueError if closed meanwhile
+        return None
+    return struct.unpack("i", count)[0]
+
+
+class StatePublisher(threading.Thread):
+    """Sends the latest eye state to every connected client at a fixed
+       rate, from its own thread, so that neither a slow client nor slow
+       camera processing holds up the other. get_state(now) is called
+       once per tick and should return the shared state dict; new
+       connections on the (listening) socket lsock are accepted as they
+       arrive. If multicast is given as a (group, port) tuple, each state
+       is also sent once as a UDP datagram to that group, however many
+       clients are listening; lsock may be None for multicast only.
+       If timer is set to a perfutil.FrameTimer, each tick is timed as
+       "model" (get_state) and "send" stages, and per-client send latency
+       is recorded; see client_stats(). The selector is only touched from
+       the publisher thread; other threads see the connected clients
+       through an immutable snapshot, replaced whenever one connects or
+       disconnects."""
+
+    def __init__(self, lsock, rate, get_state, multicast=None):
+        threading.Thread.__init__(self, name="StatePublisher", daemon=True)
+        self.interval = 1.0 / rate
+        self.get_state = get_state
+        self.seq = 0 # Message sequence number
+        self.timer = None
+        self._running = True
+        self._clients = () # (socket, data) of each client
+        self.sel = selectors.DefaultSelector()
+        if lsock is not None:
+            lsock.setblocking(False)
+            self.sel.register(lsock, selectors.EVENT_READ, data=None)
+        self.multicast = multicast
+        self.msock = None
+        if multicast is not None:
+            self.msock = open_multicast_sender(multicast[0])
+
+    def accept_wrapper(self, sock):
+        conn, addr = sock.accept()  # Should be ready to read
+        print("accepted connection from", addr)
+        conn.setblocking(False)
+        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"",
+                                     first_seq=self.seq, sent=0,
+                                     queued_time=0.0,
+                                     latency=RollingStats())
+        self.sel.register(conn, selectors.EVENT_WRITE, data=data)
+        self._clients += ((conn, data),)
+
+    def service_connection(self, key, mask, message, now=None):
+        sock = key.fileobj
+        data = key.data
+        if mask & selectors.EVENT_WRITE:
+            # Only queue the latest state once any partly sent message has
+            # gone, so a slow client skips states instead of falling behind
+            if not data.outb:
+                data.outb = message
+                data.queued_time = now
+            try:
+                sent = sock.send(data.outb)  # Should be ready to write
+            except OSError:
+                print("closing connection to", data.addr)
+                self.sel.unregister(sock)
+                self._clients = tuple(client for client in self._clients
+                                      if client[0] is not sock)
+                sock.close()
+                return
+            data.outb = data.outb[sent:]
+            if not data.outb:
+                data.sent += 1
+                if self.timer is not None and data.queued_time is not None:
+                    data.latency.add(time.time() - data.queued_time)
+
+    def client_stats(self):
+        """Return a dict, by client address, of states sent, states
+           skipped because the client wasn't ready, bytes waiting to be
+           sent (in the publisher and, on Linux, in the kernel) and, while
+           timed, the latency in milliseconds from a state being
+           published to it being handed to the kernel. Safe to call from
+           another thread."""
+        stats = {}
+        for sock, data in self._clients:
+            latency = data.latency.summary()
+            if latency is not None:
+                for name in ("p50", "p95", "p99", "max"):
+                    latency[name] *= 1000.0
+            stats["%s:%d" % data.addr[:2]] = {
+                "sent": data.sent,
+                "skipped": max(self.seq - data.first_seq - data.sent, 0),
+                "backlog": len(data.outb),
+                "unsent": _unsent_bytes(sock),
+                "latency": latency}
+        return stats
+
+    def publish(self, now):
+        """Send one state update to all clients that are ready for it."""
+        timer = self.timer
+        if timer is not None:
+            timer.next_frame()
+        shared = self.get_state(now)
+        if timer is not None:
+            timer.lap("model")
+        self.seq += 1
+        message = pack_state(shared, self.seq, now)
+        if self.msock is not None:
+            try:
+                self.msock.sendto(message, self.multicast)
+            except OSError:
+                pass # Dropped; datagrams are best effort anyway
+        if self.sel.get_map():
+            for key, mask in self.sel.select(timeout=0):
+                if key.data is None:
+                    self.accept_wrapper(key.fileobj)
+                else:
+                    self.service_connection(key, mask, message, now)
+        if timer is not None:
+            timer.lap("send")
+
+    def run(self):
+        next_time = time.time()
+        while self._running:
+            self.publish(time.time())
+            next_time += self.interval
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.time() # Fell behind; don't try to catch up
+
+    def stop(self):
+        """Stop the publisher thread and close all connections."""
+        self._running = False
+        if self.is_alive():
+            self.join()
+        for key in list(self.sel.get_map().values()):
+            key.fileobj.close()
+        self.sel.close()
+        if self.msock is not None:
+            self.msock.close()
+
+
+class DiscoveryResponder(threading.Thread):
+    """Server side of discovery: answers "who-is" queries from clients,
+       sent by broadcast or to the multicast group, with the (address,
+       port) the server's TCP socket is listening on (normally
+       lsock.getsockname()). An address of 0.0.0.0 (all interfaces) tells
+       the client to use the address the reply came from."""
+
+    def __init__(self, listen_addr, group=MULTICAST_GROUP,
+                 discovery_port=DISCOVERY_PORT):
+        threading.Thread.__init__(self, name="DiscoveryResponder",
+                                  daemon=True)
+        self.reply = DISCOVERY_REPLY + DISCOVERY_ADDRESS.pack(
+            socket.inet_aton(listen_addr[0]), listen_addr[1])
+        self.sock = open_multicast_receiver(group, discovery_port)
+        self._running = True
+
+    def run(self):
+        while self._running:
+            readable = select.select([self.sock], [], [], 0.5)[0]
+            if not readable:
+                continue
+            try:
+                query, addr = self.sock.recvfrom(64)
+                if query == DISCOVERY_QUERY:
+                    self.sock.sendto(self.reply, addr)
+            except OSError:
+                pass
+
+    def stop(self):
+        self._running = False
+        if self.is_alive():
+            self.join()
+        self.sock.close()
+
+
+def _is_local_address(addr):
+    """True if addr is one of this machine's own addresses."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind((addr, 0))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def discover_server(timeout=0.25, group=MULTICAST_GROUP,
+                    discovery_port=DISCOVERY_PORT):
+    """Send a who-is query by broadcast and multicast and wait 'timeout'
+       seconds for servers to reply. Returns a list of the (address, TCP
+       port) of every server that replied, in the order the replies
+       arrived (possibly empty). A server listening on all interfaces is
+       reached at the address its reply came from; one listening only on
+       its loopback address is skipped unless it's on this machine."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                         socket.IPPROTO_UDP)
+    servers = []
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        for addr in ("255.255.255.255", group, "127.0.0.1"):
+            try:
+                sock.sendto(DISCOVERY_QUERY, (addr, discovery_port))
+            except OSError:
+                pass # e.g. no broadcast route; try the others
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return servers
+            if not select.select([sock], [], [], remaining)[0]:
+                return servers
+            reply, (from_addr, _) = sock.recvfrom(64)
+            if (len(reply) != len(DISCOVERY_REPLY) + DISCOVERY_ADDRESS.size
+                    or not reply.startswith(DISCOVERY_REPLY)):
+                continue
+            packed_addr, port = DISCOVERY_ADDRESS.unpack_from(
+                reply, len(DISCOVERY_REPLY))
+            addr = socket.inet_ntoa(packed_addr)
+            if addr == "0.0.0.0":
+                addr = from_addr
+            elif (addr.startswith("127.") and
+                  not from_addr.startswith("127.") and
+                  not _is_local_address(from_addr)):
+                continue # Only reachable on the server's own machine
+            if (addr, port) not in servers:
+                servers.append((addr, port))
+    finally:
+        sock.close()
+
+
+def sweep_connect(host, port, timeout=1.0):
+    """Fallback for when discovery gets no answer: try to connect to port
+       on every address in host's /24 network at once, using
+       non-blocking sockets. Returns the first connected socket (in
+       non-blocking mode), or None."""
+    net = host.split(".")[0:3]
+    pending = {}
+    for ip_lsb in range(1, 255):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        err = sock.connect_ex((".".join(net + [str(ip_lsb)]), port))
+        if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            pending[sock.fileno()] = sock
+        else:
+            sock.close()
+    found = None
+    deadline = time.time() + timeout
+    while pending and found is None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        writable = select.select([], list(pending.values()), [],
+                                 remaining)[1]
+        if not writable:
+            break
+        for sock in writable:
+            del pending[sock.fileno()]
+            if (found is None and
+                    sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0):
+                found = sock
+            else:
+                sock.close()
+    for sock in pending.values():
+        sock.close()
+    return found
+
+
+def load_server_address(filename):
+    """Read a cached (address, port) from file, or None."""
+    try:
+        with open(filename) as in_file:
+            addr, port = in_file.read().split()
+            return (addr, int(port))
+    except (OSError, ValueError):
+        return None
+
+
+def save_server_address(filename, server_addr):
+    """Cache the server's (address, port) in file for next time."""
+    try:
+        with open(filename, "w") as out_file:
+            out_file.write("%s %d\n" % server_addr)
+    except OSError:
+        pass # Read-only install; just go without
+
+
+def _try_connect(server_addr, timeout):
+    try:
+        return socket.create_connection(server_addr, timeout)
+    except OSError:
+        return None
+
+
+def find_server(host, port, cache_file=None, timeout=0.25):
+    """Find and connect to the eye server, trying in turn: the address
+       cached in cache_file from last time, a discovery query, and a
+       sweep of host's /24 network. Returns a connected non-blocking
+       socket (and updates the cache), or None."""
+    sock = None
+    if cache_file is not None:
+        cached = load_server_address(cache_file)
+        if cached is not None:
+            sock = _try_connect(cached, timeout)
+    if sock is None:
+        for discovered in discover_server(timeout):
+            sock = _try_connect(discovered, timeout)
+            if sock is not None:
+                break
+    if sock is None:
+        sock = sweep_connect(host, port)
+        if sock is None:
+            return None
+    sock.setblocking(False)
+    if cache_file is not None:
+        save_server_address(cache_file, sock.getpeername()[0:2])
+    return sock
+
+
+class ConnectionManager(object):
+    """Client side connection to the eye server. Call poll() regularly
+       from the main loop; received states are passed to
+       on_state(state, receive time), times being time.monotonic().
+       Finding the server can take a while, so connection attempts run in
+       a short-lived helper thread and never hold up the caller. The
+       state stream doubles as a heartbeat: if nothing arrives for
+       heartbeat_timeout seconds the server is taken to be gone, and the
+       client reconnects, with exponential backoff (plus a little jitter)
+       between failed attempts. With multicast set
+       to a (group, port) tuple, states are received from that group
+       instead and there is nothing to reconnect, but alive() still
+       reports whether they're arriving.
+       Rather than polling, start() runs poll() in a background thread, so
+       network reads stay out of the render loop altogether."""
+
+    def __init__(self, on_state, host=None, port=None, cache_file=None,
+                 multicast=None, heartbeat_timeout=1.0, min_backoff=0.1,
+                 max_backoff=5.0):
+        self.on_state = on_state
+        self.host = host
+        self.port = port
+        self.cache_file = cache_file
+        self.heartbeat_timeout = heartbeat_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.next_attempt = 0.0
+        self.last_recv = 0.0
+        self.sock = None
+        self.decoder = None
+        self._connector = None
+        self._result = None
+        self._thread = None
+        self._running = False
+        if multicast is not None:
+            self.sock = open_multicast_receiver(multicast[0], multicast[1])
+            self.decoder = DatagramDecoder()
+        self.multicast = multicast
+
+    def alive(self, now=None):
+        """True if states have been arriving recently."""
+        if now is None:
+            now = time.monotonic()
+        return self.sock is not None and (now - self.last_recv <
+                                          self.heartbeat_timeout)
+
+    def _connect(self):
+        self._result = find_server(self.host, self.port, self.cache_file)
+
+    def _start_connect(self, now):
+        if self._connector is None:
+            if now >= self.next_attempt:
+                print("Searching for server")
+                self._result = None
+                self._connector = threading.Thread(target=self._connect,
+                                                   daemon=True)
+                self._connector.start()
+            return
+        if self._connector.is_alive():
+            return
+        self._connector = None
+        if self._result is None:
+            print("Could not find server; retrying in %.1f s" % self.backoff)
+            self.next_attempt = now + self.backoff * random.uniform(1.0, 1.2)
+            self.backoff = min(self.backoff * 2.0, self.max_backoff)
+            return
+        self.sock = self._result
+        self.decoder = StateDecoder()
+        self.last_recv = now # Give the server a chance to start sending
+        self.backoff = self.min_backoff
+        print("Connected to", self.sock.getpeername())
+
+    def _disconnect(self, now, reason):
+        print("Lost server (%s); reconnecting" % reason)
+        self.sock.close()
+        self.sock = None
+        self.next_attempt = now + self.backoff
+        self.backoff = min(self.backoff * 2.0, self.max_backoff)
+
+    def poll(self, timeout=0.0):
+        """Receive any waiting data, waiting up to timeout seconds for it,
+           and handle (re)connection."""
+        now = time.monotonic()
+        if self.sock is None:
+            self._start_connect(now)
+            if self.sock is None:
+                if timeout > 0:
+                    time.sleep(timeout)
+                return
+        if select.select([self.sock], [], [], timeout)[0]:
+            try:
+                recv_data = self.sock.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                recv_data = None
+            except OSError as err:
+                if self.multicast is None:
+                    self._disconnect(now, err)
+                return
+            now = time.monotonic()
+            if recv_data == b"" and self.multicast is None:
+                self._disconnect(now, "closed")
+                return
+            if recv_data:
+                # Messages may arrive split or several at once (or stale,
+                # for multicast); hand them all over in order
+                for state in self.decoder.feed(recv_data):
+                    self.last_recv = now
+                    self.on_state(state, now)
+        if self.multicast is None and not self.alive(now):
+            self._disconnect(now, "no heartbeat")
+
+    def _run(self):
+        while self._running:
+            self.poll(timeout=0.05)
+
+    def start(self):
+        """Handle the connection from a background thread from now on."""
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name="ConnectionManager", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is not None:
+            self._running = False
+            self._thread.join()
+            self._thread = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,181 @@
+"""Low overhead per-frame stage timing, for finding out where the eye
+   clients and server spend their time. A FrameTimer keeps the last
+   'size' frames' stage times in a ring buffer and summarizes them as
+   p50 / p95 / p99 percentiles on request, so the render or camera loop
+   only pays for a clock read and an array store per stage. The summary
+   can be printed, served as JSON over HTTP by a StatsServer, or appended
+   to a JSON lines file by a JSONLinesLog. RollingStats does the same for
+   a single measurement, such as one client's send latency."""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import numpy as np
+
+PERCENTILES = (50, 95, 99)
+
+# Histogram bin edges, in milliseconds; the last bin is everything over
+HISTOGRAM_EDGES = (0.0, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0,
+                   100.0)
+
+
+def _describe(values, histogram=False):
+    """p50, p95, p99 and max of an array of values, and optionally counts
+       in each HISTOGRAM_EDGES bin."""
+    stats = dict(zip(("p50", "p95", "p99"),
+                     np.percentile(values, PERCENTILES).tolist()))
+    stats["max"] = float(values.max())
+    if histogram:
+        edges = HISTOGRAM_EDGES + (max(stats["max"], HISTOGRAM_EDGES[-1]),)
+        stats["hist"] = np.histogram(values, edges)[0].tolist()
+    return stats
+
+
+class FrameTimer(object):
+    """Ring buffer of per-frame times for a fixed list of stage names.
+       Call next_frame() at the start of every frame, then lap(stage) at
+       the end of each stage; each lap is the time since the previous one
+       (or the start of the frame), and laps for the same stage within a
+       frame add up."""
+
+    def __init__(self, stages, size=1024):
+        self.stages = tuple(stages)
+        self.size = size
+        self.frames = 0
+        self._columns = dict((name, i) for i, name in enumerate(self.stages))
+        self._times = np.zeros((size, len(self.stages)))
+        self._starts = np.zeros(size) # Frame start times
+        self._row = self._times[0]
+        self._last = time.perf_counter()
+
+    def next_frame(self):
+        """Finish the current frame (if any) and start timing a new one."""
+        self._last = time.perf_counter()
+        self.frames += 1
+        row = self.frames % self.size
+        self._starts[row] = self._last
+        self._row = self._times[row]
+        self._row[:] = 0.0
+
+    def lap(self, stage):
+        """Add the time since the last lap to a stage of this frame."""
+        now = time.perf_counter()
+        self._row[self._columns[stage]] += now - self._last
+        self._last = now
+
+    def summary(self, histogram=False):
+        """Return a dict of the frame rate, and p50, p95, p99 and max
+           times in milliseconds for each stage (and the "total" of all
+           stages), over the finished frames in the buffer. If histogram
+           is True each stage also gets its HISTOGRAM_EDGES bin counts.
+           Safe to call from another thread; a frame being written at the
+           time may be slightly off."""
+        frames = self.frames
+        count = max(min(frames - 1, self.size - 1), 0)
+        # Finished frames are the 'count' rows before the current one
+        rows = np.arange(frames - count, frames + 1) % self.size
+        starts = self._starts[rows]
+        times = self._times[rows[:-1]] * 1000.0
+        fps = 0.0
+        stats = {}
+        if count:
+            fps = count / max(starts[-1] - starts[0], 1e-9)
+            columns = [times[:, i] for i in range(len(self.stages))]
+            columns.append(times.sum(axis=1))
+            for name, column in zip(self.stages + ("total",), columns):
+                stats[name] = _describe(column, histogram)
+        return {"time": time.time(), "frames": frames, "window": count,
+                "fps": fps, "stages": stats}
+
+
+class RollingStats(object):
+    """Ring buffer of the last 'size' values of one measurement,
+       summarized the same way as a FrameTimer stage."""
+
+    def __init__(self, size=256):
+        self.size = size
+        self.count = 0
+        self._values = np.zeros(size)
+
+    def add(self, value):
+        self._values[self.count % self.size] = value
+        self.count += 1
+
+    def summary(self, histogram=False):
+        """Return a dict of the number of values added, and percentiles
+           (see FrameTimer.summary()) of those in the buffer, or None if
+           there aren't any yet."""
+        if not self.count:
+            return None
+        stats = _describe(self._values[:min(self.count, self.size)],
+                          histogram)
+        stats["count"] = self.count
+        return stats
+
+
+def format_summary(summary, skip_idle=False):
+    """One line of a FrameTimer summary, for the console. If skip_idle,
+       stages that took no time at all are left out."""
+    parts = ["%.1f fps" % summary["fps"]]
+    for name, stats in summary["stages"].items():
+        if skip_idle and not stats["max"]:
+            continue
+        parts.append("%s %.1f/%.1f/%.1f" % (name, stats["p50"],
+                                            stats["p95"], stats["p99"]))
+    return " | ".join(parts) + " ms (p50/p95/p99)"
+
+
+class JSONLinesLog(object):
+    """Appends records (dicts) to a file as one line of JSON each, for
+       later analysis."""
+
+    def __init__(self, filename):
+        self.file = open(filename, "a")
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class _StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(self.server.get_stats()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass # Keep the console quiet
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in its own daemon thread, so a
+       slow or long-lived client (like an MJPEG viewer) can't hold up the
+       others, or stop the program exiting."""
+
+    daemon_threads = True
+
+
+class StatsServer(object):
+    """Serves get_stats() (normally a FrameTimer's summary method) as JSON
+       at http://host:port/, from a background thread. Only costs anything
+       when someone asks."""
+
+    def __init__(self, port, get_stats, host="127.0.0.1"):
+        self.httpd = ThreadingHTTPServer((host, port), _StatsHandler)
+        self.httpd.get_stats = get_stats
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name="StatsServer", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()